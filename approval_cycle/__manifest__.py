@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 {
     "name": "Dynamic Approval System",
-    "version": "18.0.1.1.0",
+    "version": "18.0.1.2.0",
     "category": "Extra Tools", 
     "summary": "Generic Dynamic Approval Workflow Engine",
     "description": """
@@ -22,10 +22,15 @@
         "security/security_groups.xml", 
         "security/ir.model.access.csv",
         "security/record_rules.xml",
+        # Data
+        "data/ir_cron_data.xml",
         # Views
         "views/dynamic_approval_rule_views.xml",
         "views/approval_request_views.xml",
         "views/approval_method_views.xml",
+        "views/approval_interceptor_metric_views.xml",
+        "views/approval_request_archive_views.xml",
+        "views/approval_report_views.xml",
     ],
     "installable": True,
     "application": True, 
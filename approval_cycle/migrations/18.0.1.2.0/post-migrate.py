@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import SUPERUSER_ID, api
+from odoo.tools import SQL, split_every
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    _index_pending_requests(env)
+    _fill_decision_summary(env)
+
+
+def _index_pending_requests(env):
+    """ Index the approvers of the requests that were pending before the approver
+    index existed: the inbox, the approve buttons and the record rules read it. """
+    Request = env["approval.request"]
+    request_ids = Request.search([("state", "=", "pending")]).ids
+    for ids in split_every(10000, request_ids):
+        Request.browse(ids)._sync_approver_index()
+        Request.invalidate_model()
+    _logger.info("Indexed the approvers of %s pending approval request(s)", len(request_ids))
+
+
+def _fill_decision_summary(env):
+    """ Fill the decision summary of the requests decided before it was stored
+    on them, from their approval logs. """
+    Request = env["approval.request"]
+    env.cr.execute(SQL(
+        """
+        UPDATE %(request)s req
+           SET last_decision = last.decision,
+               last_decision_user_id = last.user_id,
+               last_decision_date = last.decision_date,
+               rejection_reason = agg.rejection_reason,
+               steps_completed = agg.steps_completed
+          FROM (SELECT DISTINCT ON (request_id) request_id, decision, user_id, decision_date
+                  FROM %(log)s
+                 WHERE decision IN ('approved', 'rejected')
+              ORDER BY request_id, decision_date DESC, id DESC) last
+          JOIN (SELECT request_id,
+                       count(*) FILTER (WHERE decision = 'approved') AS steps_completed,
+                       (array_agg(reason ORDER BY decision_date DESC, id DESC)
+                            FILTER (WHERE decision = 'rejected'))[1] AS rejection_reason
+                  FROM %(log)s
+              GROUP BY request_id) agg ON agg.request_id = last.request_id
+         WHERE req.id = last.request_id AND req.last_decision IS NULL
+        """,
+        request=SQL.identifier(Request._table),
+        log=SQL.identifier(env["approval.request.log"]._table),
+    ))
+    _logger.info("Filled the decision summary of %s approval request(s)", env.cr.rowcount)
+    Request.invalidate_model()
@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 from . import dynamic_approval_rule
 from . import approval_request
+from . import approval_request_queue
+from . import approval_request_archive
+from . import approval_notification_digest
+from . import approval_report
+from . import approval_interceptor_metric
 from . import base_model_patch
 from . import studio_approval_method
 from . import patch_handeler
+from . import res_groups
+from . import res_users
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import api, fields, models
+from odoo.tools import SQL
+
+_logger = logging.getLogger(__name__)
+
+# Counters and timings collected by the interceptor, in the order of the table columns
+METRIC_FIELDS = [
+    "call_count",
+    "record_count",
+    "match_count",
+    "query_count",
+    "domain_cache_hits",
+    "domain_cache_misses",
+    "rule_lookup_time",
+    "domain_time",
+    "request_lookup_time",
+    "request_creation_time",
+    "total_time",
+]
+
+
+class ApprovalInterceptorMetric(models.Model):
+    """ Cumulated cost of the approval interceptor, per patched method and per rule.
+
+    Every worker collects metrics in memory and adds them here about once a minute.
+    Rows without rule hold the totals of the method; rows with a rule hold the
+    domain evaluation time and matches of that rule.
+    """
+    _name = "approval.interceptor.metric"
+    _description = "Approval Interceptor Metric"
+    _order = "total_time desc, domain_time desc"
+    _log_access = False
+
+    model_name = fields.Char(string="Model", required=True, readonly=True)
+    method_name = fields.Char(string="Method", required=True, readonly=True)
+    rule_id = fields.Many2one("dynamic.approval.rule", string="Rule", readonly=True, ondelete="cascade")
+    call_count = fields.Integer(string="Intercepted Calls", readonly=True)
+    record_count = fields.Integer(string="Records Evaluated", readonly=True)
+    match_count = fields.Integer(string="Matches", readonly=True)
+    query_count = fields.Integer(string="SQL Queries", readonly=True)
+    domain_cache_hits = fields.Integer(string="Domain Cache Hits", readonly=True)
+    domain_cache_misses = fields.Integer(string="Domain Cache Misses", readonly=True)
+    rule_lookup_time = fields.Float(string="Rule Lookup (s)", readonly=True)
+    domain_time = fields.Float(string="Domain Evaluation (s)", readonly=True)
+    request_lookup_time = fields.Float(string="Request Lookup (s)", readonly=True)
+    request_creation_time = fields.Float(string="Request Creation (s)", readonly=True)
+    total_time = fields.Float(string="Total Time (s)", readonly=True)
+    last_update = fields.Datetime(string="Last Update", readonly=True)
+
+    def init(self):
+        super().init()
+        self.env.cr.execute(SQL(
+            "CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (model_name, method_name, COALESCE(rule_id, 0))",
+            SQL.identifier(f"{self._table}_key_uniq"), SQL.identifier(self._table),
+        ))
+
+    @api.model
+    def _accumulate(self, metrics):
+        """ Add ``metrics`` to the stored ones.
+
+        :param dict metrics: ``{(model_name, method_name, rule_id or 0): {field: value}}``
+        """
+        columns = SQL(", ").join(SQL.identifier(fname) for fname in METRIC_FIELDS)
+        rows = SQL(", ").join(
+            SQL("(%s, %s, %s, %s, now() AT TIME ZONE 'UTC')",
+                model_name, method_name, rule_id or None,
+                SQL(", ").join(SQL("%s", values.get(fname, 0)) for fname in METRIC_FIELDS))
+            for (model_name, method_name, rule_id), values in metrics.items()
+        )
+        updates = SQL(", ").join(
+            SQL("%s = COALESCE(%s.%s, 0) + EXCLUDED.%s", SQL.identifier(fname), SQL.identifier(self._table),
+                SQL.identifier(fname), SQL.identifier(fname))
+            for fname in METRIC_FIELDS
+        )
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO %(table)s (model_name, method_name, rule_id, %(columns)s, last_update)
+                 VALUES %(rows)s
+            ON CONFLICT (model_name, method_name, COALESCE(rule_id, 0))
+              DO UPDATE SET %(updates)s, last_update = EXCLUDED.last_update
+            """,
+            table=SQL.identifier(self._table), columns=columns, rows=rows, updates=updates,
+        ))
+        for (model_name, method_name, rule_id), values in metrics.items():
+            if not rule_id:
+                _logger.info(
+                    "Approval interceptor %s.%s: %d calls, %d records, %d matches, %d queries, "
+                    "%d/%d domain cache hits, %.3fs "
+                    "(rules %.3fs, domains %.3fs, requests lookup %.3fs, creation %.3fs)",
+                    model_name, method_name, values.get("call_count", 0), values.get("record_count", 0),
+                    values.get("match_count", 0), values.get("query_count", 0),
+                    values.get("domain_cache_hits", 0),
+                    values.get("domain_cache_hits", 0) + values.get("domain_cache_misses", 0),
+                    values.get("total_time", 0),
+                    values.get("rule_lookup_time", 0), values.get("domain_time", 0),
+                    values.get("request_lookup_time", 0), values.get("request_creation_time", 0),
+                )
+
+    def action_reset(self):
+        self.unlink()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+
+from markupsafe import Markup
+
+from odoo import _, api, fields, models
+from odoo.tools import SQL
+
+_logger = logging.getLogger(__name__)
+
+DIGEST_LAST_RUN_PARAM = "dynamic_approval.digest_last_run"
+DIGEST_MAX_LINES = 20
+
+
+class ApprovalNotificationDigest(models.Model):
+    """ Requester notification waiting for the next digest, for rules in digest mode. """
+    _name = "approval.notification.digest"
+    _description = "Approval Notification Digest"
+    _order = "user_id, id"
+
+    user_id = fields.Many2one("res.users", string="Recipient", required=True, ondelete="cascade", index=True)
+    request_id = fields.Many2one("approval.request", string="Request", ondelete="cascade")
+    body = fields.Text(string="Message", required=True)
+
+    @api.model
+    def _cron_send_digests(self, batch_size=200):
+        """ Send every user a single summary of the decisions taken on their requests,
+        and of the requests waiting for their approval since the previous digest. """
+        auto_commit = not getattr(threading.current_thread(), "testing", False)
+        ICP = self.env["ir.config_parameter"].sudo()
+        last_run = ICP.get_param(DIGEST_LAST_RUN_PARAM) or "1970-01-01 00:00:00"
+        now = fields.Datetime.to_string(fields.Datetime.now())
+
+        pending_by_user = self._get_new_pending_requests(last_run, now)
+        while True:
+            entries = self.search([], limit=batch_size)
+            # Keep all the entries of the last user of the batch together
+            if len(entries) == batch_size:
+                entries |= self.search([("user_id", "=", entries[-1].user_id.id)])
+            if not entries:
+                break
+            for user, user_entries in entries.grouped("user_id").items():
+                self._send_digest(user, user_entries.mapped("body"), pending_by_user.pop(user.id, []))
+            entries.unlink()
+            if auto_commit:
+                self.env.cr.commit()
+
+        for user_id, request_ids in pending_by_user.items():
+            self._send_digest(self.env["res.users"].browse(user_id), [], request_ids)
+        ICP.set_param(DIGEST_LAST_RUN_PARAM, now)
+
+    @api.model
+    def _get_new_pending_requests(self, date_from, date_to):
+        """ Return ``{user id: [request ids]}`` for the requests of digest-mode rules
+        that entered a step the user can approve between ``date_from`` and ``date_to``. """
+        Request = self.env["approval.request"]
+        Request.flush_model(["rule_id", "step_entered_date"])
+        self.env["approval.request.approver"].flush_model()
+        self.env.cr.execute(SQL(
+            """
+            SELECT idx.user_id, array_agg(req.id ORDER BY req.step_entered_date)
+              FROM %(index)s idx
+              JOIN %(request)s req ON req.id = idx.request_id
+              JOIN %(rule)s rule ON rule.id = req.rule_id
+             WHERE rule.notification_mode = 'digest'
+               AND req.step_entered_date > %(date_from)s AND req.step_entered_date <= %(date_to)s
+          GROUP BY idx.user_id
+            """,
+            index=SQL.identifier(self.env["approval.request.approver"]._table),
+            request=SQL.identifier(Request._table),
+            rule=SQL.identifier(self.env["dynamic.approval.rule"]._table),
+            date_from=date_from,
+            date_to=date_to,
+        ))
+        return dict(self.env.cr.fetchall())
+
+    @api.model
+    def _send_digest(self, user, decisions, pending_request_ids):
+        if not user.partner_id or not (decisions or pending_request_ids):
+            return
+        body = Markup()
+        if pending_request_ids:
+            pending = self.env["approval.request"].browse(pending_request_ids[:DIGEST_MAX_LINES])
+            body += Markup("<p>%s</p><ul>%s</ul>") % (
+                _("%s new request(s) are waiting for your approval:", len(pending_request_ids)),
+                Markup().join(Markup("<li>%s</li>") % req.name for req in pending),
+            )
+        if decisions:
+            body += Markup("<p>%s</p><ul>%s</ul>") % (
+                _("Updates on your approval requests:"),
+                Markup().join(Markup("<li>%s</li>") % line for line in decisions[:DIGEST_MAX_LINES]),
+            )
+        hidden = max(len(pending_request_ids) - DIGEST_MAX_LINES, 0) + max(len(decisions) - DIGEST_MAX_LINES, 0)
+        if hidden:
+            body += Markup("<p>%s</p>") % _("… and %s more.", hidden)
+        self.env["mail.thread"].sudo().message_notify(
+            partner_ids=user.partner_id.ids,
+            subject=_("Approvals digest"),
+            body=body,
+        )
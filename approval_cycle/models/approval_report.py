@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+
+from odoo import api, fields, models, tools
+from odoo.tools import SQL
+
+_logger = logging.getLogger(__name__)
+
+SUMMARY_TABLE = "approval_report_summary"
+SUMMARY_WATERMARK_PARAM = "dynamic_approval.report_log_watermark"
+# Log ids re-scanned below the watermark, for the logs committed out of id order
+SUMMARY_WATERMARK_OVERLAP = 1000
+
+
+class ApprovalReport(models.Model):
+    """ Approval decisions analysis: one line per approval or rejection, with the
+    time the request spent in the step before the decision.
+
+    The lines are read from a summary table that the refresh cron fills from the
+    approval logs created since its previous run, so that the report does not
+    recompute the step durations on every read, and outlives the requests removed
+    by the retention cron.
+    """
+    _name = "approval.report"
+    _description = "Approval Analysis"
+    _auto = False
+    _order = "decision_date desc"
+    _rec_name = "request_id"
+
+    request_id = fields.Many2one("approval.request", string="Request", readonly=True)
+    rule_id = fields.Many2one("dynamic.approval.rule", string="Rule", readonly=True)
+    res_model = fields.Char(string="Model", readonly=True)
+    step_id = fields.Many2one("dynamic.approval.rule.step", string="Step", readonly=True)
+    user_id = fields.Many2one("res.users", string="Decided By", readonly=True)
+    decision = fields.Selection([
+        ("approved", "Approved"),
+        ("rejected", "Rejected"),
+    ], string="Decision", readonly=True)
+    decision_date = fields.Datetime(string="Decision Date", readonly=True)
+    step_hours = fields.Float(string="Time in Step (Hours)", readonly=True, aggregator="avg",
+                              help="Time between the request entering the step and the decision.")
+    decision_count = fields.Integer(string="# Decisions", readonly=True)
+    approved_count = fields.Integer(string="# Approvals", readonly=True)
+    rejected_count = fields.Integer(string="# Rejections", readonly=True)
+    rejection_rate = fields.Float(string="Rejection Rate (%)", readonly=True, aggregator="avg",
+                                  help="Share of the decisions that are rejections.")
+
+    def init(self):
+        cr = self.env.cr
+        cr.execute(SQL(
+            """
+            CREATE TABLE IF NOT EXISTS %s (
+                log_id integer PRIMARY KEY,
+                request_id integer NOT NULL,
+                rule_id integer,
+                res_model varchar,
+                step_id integer,
+                user_id integer,
+                decision varchar NOT NULL,
+                decision_date timestamp NOT NULL,
+                step_hours double precision
+            )
+            """,
+            SQL.identifier(SUMMARY_TABLE),
+        ))
+        tools.create_index(cr, "approval_report_summary_date_idx", SUMMARY_TABLE, ["decision_date"])
+        tools.drop_view_if_exists(cr, self._table)
+        cr.execute(SQL("CREATE OR REPLACE VIEW %s AS (%s)", SQL.identifier(self._table), self._query()))
+
+    def _query(self):
+        # Requests and rules removed since are left out of the relations, not the figures
+        return SQL(
+            """
+            SELECT summary.log_id AS id,
+                   req.id AS request_id,
+                   rule.id AS rule_id,
+                   summary.res_model,
+                   step.id AS step_id,
+                   summary.user_id,
+                   summary.decision,
+                   summary.decision_date,
+                   summary.step_hours,
+                   1 AS decision_count,
+                   (summary.decision = 'approved')::int AS approved_count,
+                   (summary.decision = 'rejected')::int AS rejected_count,
+                   CASE WHEN summary.decision = 'rejected' THEN 100.0 ELSE 0.0 END AS rejection_rate
+              FROM %(summary)s summary
+         LEFT JOIN %(request)s req ON req.id = summary.request_id
+         LEFT JOIN %(rule)s rule ON rule.id = summary.rule_id
+         LEFT JOIN %(step)s step ON step.id = summary.step_id
+            """,
+            summary=SQL.identifier(SUMMARY_TABLE),
+            request=SQL.identifier(self.env["approval.request"]._table),
+            rule=SQL.identifier(self.env["dynamic.approval.rule"]._table),
+            step=SQL.identifier(self.env["dynamic.approval.rule.step"]._table),
+        )
+
+    @api.model
+    def _cron_refresh_summary(self, batch_size=50000):
+        """ Add the decisions logged since the previous run to the summary table,
+        by ranges of ``batch_size`` log ids, committing after each range. """
+        auto_commit = not getattr(threading.current_thread(), "testing", False)
+        ICP = self.env["ir.config_parameter"].sudo()
+        Log = self.env["approval.request.log"]
+        Log.flush_model()
+        self.env.cr.execute(SQL("SELECT max(id) FROM %s", SQL.identifier(Log._table)))
+        max_id = self.env.cr.fetchone()[0] or 0
+        watermark = int(ICP.get_param(SUMMARY_WATERMARK_PARAM) or 0)
+        lower = max(watermark - SUMMARY_WATERMARK_OVERLAP, 0)
+        inserted = 0
+        while lower < max_id:
+            upper = min(lower + batch_size, max_id)
+            inserted += self._refresh_summary(lower, upper)
+            ICP.set_param(SUMMARY_WATERMARK_PARAM, max(upper, watermark))
+            if auto_commit:
+                self.env.cr.commit()
+            lower = upper
+        _logger.info(f"Added {inserted} approval decisions to the analysis")
+
+    @api.model
+    def _refresh_summary(self, lower, upper):
+        """ Summarize the decisions logged with an id in ``(lower, upper]``.
+
+        The time in step is the time since the previous decision on the request,
+        or since the request date for the first one; the previous decisions are
+        looked up among all the logs of the requests concerned.
+
+        :return: number of rows added, the rows already summarized being skipped
+        """
+        Log = self.env["approval.request.log"]
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO %(summary)s (log_id, request_id, rule_id, res_model, step_id, user_id,
+                                     decision, decision_date, step_hours)
+            SELECT log.id, log.request_id, req.rule_id, req.res_model, log.step_id, log.user_id,
+                   log.decision, log.decision_date,
+                   EXTRACT(EPOCH FROM log.decision_date - COALESCE(log.previous_date, req.request_date)) / 3600
+              FROM (
+                    SELECT id, request_id, step_id, user_id, decision, decision_date,
+                           LAG(decision_date) OVER (PARTITION BY request_id ORDER BY decision_date, id) AS previous_date
+                      FROM %(log)s
+                     WHERE request_id IN (SELECT request_id FROM %(log)s WHERE id > %(lower)s AND id <= %(upper)s)
+                   ) log
+              JOIN %(request)s req ON req.id = log.request_id
+             WHERE log.id > %(lower)s AND log.id <= %(upper)s
+               AND log.decision IN ('approved', 'rejected')
+                ON CONFLICT (log_id) DO NOTHING
+            """,
+            summary=SQL.identifier(SUMMARY_TABLE),
+            log=SQL.identifier(Log._table),
+            request=SQL.identifier(self.env["approval.request"]._table),
+            lower=lower,
+            upper=upper,
+        ))
+        return self.env.cr.rowcount
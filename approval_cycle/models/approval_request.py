@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
-from odoo import models, fields, api, _
+import json
+import threading
+import time
+from datetime import timedelta
+
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import UserError
+from odoo.tools import SQL
 import logging
 _logger = logging.getLogger(__name__)
 
+# Replay of the approved method: attempts before giving up, and base delay of the exponential backoff
+EXEC_MAX_ATTEMPTS = 5
+EXEC_RETRY_DELAY_MINUTES = 2
+
 class ApprovalRequest(models.Model):
     """ Represents a specific instance of an approval process triggered by a rule. """
     _name = "approval.request"
@@ -33,6 +43,11 @@ class ApprovalRequest(models.Model):
         compute="_compute_resource_ref", 
         readonly=True
     )
+    res_name = fields.Char(
+        string="Document Name",
+        compute="_compute_res_name",
+        help="Current display name of the document, resolved on read."
+    )
     origin_user_id = fields.Many2one(
         "res.users", 
         string="Requested By", 
@@ -40,6 +55,11 @@ class ApprovalRequest(models.Model):
         readonly=True
     )
     request_date = fields.Datetime(string="Requested On", default=fields.Datetime.now, readonly=True)
+    date_closed = fields.Datetime(string="Closed On", readonly=True, copy=False)
+    date_due = fields.Datetime(string="Due On", readonly=True, copy=False, index=True,
+                               help="Deadline of the current step, as set by its SLA.")
+    is_escalated = fields.Boolean(string="Escalated", readonly=True, copy=False,
+                                  help="The escalation user or group of the current step may approve as well.")
     
     state = fields.Selection([
         ("pending", "Pending"),
@@ -57,30 +77,163 @@ class ApprovalRequest(models.Model):
     )
     current_approver_ids = fields.Many2many(
         "res.users",
-        store=True,
         string="Current Approvers", 
         compute="_compute_current_approvers",
+        search="_search_current_approver_ids",
+        compute_sudo=True,
         help="Users who can currently approve this request."
     )
+    approver_index_ids = fields.One2many(
+        "approval.request.approver",
+        "request_id",
+        string="Approver Index",
+        readonly=True,
+        help="Approvers of the current step, maintained for pending requests only."
+    )
     can_user_approve = fields.Boolean(string="Can Current User Approve?", compute="_compute_can_user_approve")
 
     log_ids = fields.One2many("approval.request.log", "request_id", string="Approval Log", readonly=True)
 
+    # Decision summary, maintained by _create_log_entry
+    last_decision = fields.Selection([
+        ("approved", "Approved"),
+        ("rejected", "Rejected"),
+    ], string="Last Decision", readonly=True, copy=False)
+    last_decision_user_id = fields.Many2one("res.users", string="Last Decided By", readonly=True, copy=False, index="btree_not_null")
+    last_decision_date = fields.Datetime(string="Last Decision On", readonly=True, copy=False, index=True)
+    rejection_reason = fields.Text(string="Rejection Reason", readonly=True, copy=False)
+    steps_completed = fields.Integer(string="Steps Completed", readonly=True, copy=False)
+    step_entered_date = fields.Datetime(string="In Current Step Since", readonly=True, copy=False, index=True,
+                                        default=fields.Datetime.now)
+
+    # Replay of the intercepted call after final approval
+    call_args = fields.Text(string="Call Arguments", readonly=True, copy=False,
+                            help="JSON-serialized arguments of the intercepted call, replayed after approval.")
+    exec_state = fields.Selection([
+        ("none", "Not Scheduled"),
+        ("queued", "Queued"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ], string="Execution Status", default="none", required=True, readonly=True, copy=False, index=True)
+    exec_attempts = fields.Integer(string="Execution Attempts", readonly=True, copy=False)
+    exec_next_date = fields.Datetime(string="Next Execution Attempt", readonly=True, copy=False)
+    exec_date = fields.Datetime(string="Executed On", readonly=True, copy=False)
+    exec_duration = fields.Float(string="Execution Time (s)", readonly=True, copy=False,
+                                 help="Time spent running the method for the batch this request was part of.")
+    exec_error = fields.Text(string="Execution Error", readonly=True, copy=False)
+
+    def init(self):
+        super().init()
+        # Serves the latest-request lookup done by the interceptor on every intercepted call
+        tools.create_index(
+            self.env.cr,
+            "approval_request_res_rule_date_idx",
+            self._table,
+            ["res_model", "res_id", "rule_id", "create_date DESC"],
+        )
+        # At most one pending request per rule and document: concurrent interceptions
+        # of the same record cannot open duplicate approval chains
+        if not tools.index_exists(self.env.cr, "approval_request_pending_uniq"):
+            # Keep the newest of the pending duplicates created before the index existed,
+            # which is also the latest request the interceptor looks up
+            self.env.cr.execute(SQL(
+                """
+                UPDATE %(table)s req
+                   SET state = 'cancel'
+                  FROM (SELECT id, row_number() OVER (
+                                   PARTITION BY rule_id, res_model, res_id ORDER BY create_date DESC, id DESC
+                               ) AS rank
+                          FROM %(table)s
+                         WHERE state = 'pending') dup
+                 WHERE req.id = dup.id AND dup.rank > 1
+             RETURNING req.id
+                """,
+                table=SQL.identifier(self._table),
+            ))
+            cancelled_ids = [row[0] for row in self.env.cr.fetchall()]
+            if cancelled_ids:
+                _logger.warning("Cancelled %s duplicate pending approval request(s)", len(cancelled_ids))
+                # Cancelled requests have no approver; the index may not exist yet on upgrade
+                Index = self.env["approval.request.approver"]
+                if tools.table_exists(self.env.cr, Index._table):
+                    self.env.cr.execute(SQL(
+                        "DELETE FROM %s WHERE request_id = ANY(%s)",
+                        SQL.identifier(Index._table), cancelled_ids,
+                    ))
+            self.env.cr.execute(SQL(
+                "CREATE UNIQUE INDEX approval_request_pending_uniq ON %s (rule_id, res_model, res_id) WHERE state = 'pending'",
+                SQL.identifier(self._table),
+            ))
+
+    @api.model
+    def _get_latest_requests(self, res_model, rule_res_ids):
+        """ Fetch the latest request of each ``(rule_id, res_id)`` pair in one query.
+
+        The pairs without a request are looked up in the archive, whose rows are
+        all older than the remaining requests of their document and rule.
+
+        :param str res_model: model of the documents
+        :param list rule_res_ids: list of ``(rule_id, res_id)`` pairs
+        :return: dict mapping each pair that has a request to its latest request,
+            or to its latest ``approval.request.archive`` record
+        """
+        if not rule_res_ids:
+            return {}
+        self.flush_model(["res_model", "res_id", "rule_id", "create_date"])
+        rule_ids, res_ids = zip(*rule_res_ids, strict=True)
+        self.env.cr.execute(SQL(
+            """
+            SELECT DISTINCT ON (req.res_id, req.rule_id) req.id, req.rule_id, req.res_id
+              FROM %s req
+              JOIN unnest(%s::int[], %s::int[]) AS pair(rule_id, res_id)
+                ON pair.rule_id = req.rule_id AND pair.res_id = req.res_id
+             WHERE req.res_model = %s
+          ORDER BY req.res_id, req.rule_id, req.create_date DESC, req.id DESC
+            """,
+            SQL.identifier(self._table), list(rule_ids), list(res_ids), res_model,
+        ))
+        rows = self.env.cr.fetchall()
+        requests = self.browse([row[0] for row in rows])
+        latest = {(rule_id, res_id): request for request, (_id, rule_id, res_id) in zip(requests, rows, strict=True)}
+        missing = [pair for pair in rule_res_ids if pair not in latest]
+        if missing:
+            latest.update(self.env["approval.request.archive"]._get_latest_archives(res_model, missing))
+        return latest
+
     @api.depends("rule_id.name", "res_model", "res_id")
     def _compute_name(self):
+        document_names = self._get_document_names()
         for req in self:
             name = req.rule_id.name or "Approval Request"
             if req.res_model and req.res_id:
+                name = f"{name} for {document_names[req.id]}"
+            req.name = name
+
+    @api.depends("res_model", "res_id")
+    def _compute_res_name(self):
+        document_names = self._get_document_names()
+        for req in self:
+            req.res_name = document_names[req.id]
+
+    def _get_document_names(self):
+        """ Return the display name of the document of each request, as a dict
+        ``{request id: name}``, fetching the names in one batch per model. """
+        names = {}
+        for res_model, requests in self.grouped("res_model").items():
+            labels = {}
+            if res_model and res_model in self.env:
                 try:
-                    record_name = self.env[req.res_model].browse(req.res_id).display_name
-                    name = f"{name} for {record_name or f'{req.res_model}/{req.res_id}'}"
+                    documents = self.env[res_model].sudo().browse(set(requests.mapped("res_id"))).exists()
+                    labels = {doc.id: doc.display_name for doc in documents}
                 except Exception:
-                    name = f"{name} for {req.res_model}/{req.res_id}"
-            req.name = name
+                    _logger.warning(f"Failed to fetch display names of {res_model} records", exc_info=True)
+            for req in requests:
+                names[req.id] = labels.get(req.res_id) or f"{req.res_model}/{req.res_id}"
+        return names
 
     @api.model
     def _selection_target_model(self):
-        return [(model.model, model.name) for model in self.env["ir.model"].sudo().search([])]
+        return list(self.env["dynamic.approval.rule"]._get_target_model_selection())
 
     @api.depends("res_model", "res_id")
     def _compute_resource_ref(self):
@@ -90,159 +243,537 @@ class ApprovalRequest(models.Model):
             else:
                 req.resource_ref = False
 
-    @api.depends("current_step_id", "current_step_id.approver_type", "current_step_id.user_id", "current_step_id.group_id", "current_step_id.group_id.users")
+    @api.depends("approver_index_ids.user_id")
     def _compute_current_approvers(self):
         for req in self:
-            if req.state == "pending" and req.current_step_id:
-                if req.current_step_id.approver_type == "user":
-                    req.current_approver_ids = req.current_step_id.user_id
-                elif req.current_step_id.approver_type == "group":
-                    req.current_approver_ids = req.current_step_id.group_id.users
-                else:
-                    req.current_approver_ids = False
-            else:
-                req.current_approver_ids = False
-                
+            req.current_approver_ids = req.approver_index_ids.user_id
+
+    def _search_current_approver_ids(self, operator, value):
+        return [("approver_index_ids.user_id", operator, value)]
+
+    # --- Approver Index --- #
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        Step = self.env["dynamic.approval.rule.step"]
+        for vals in vals_list:
+            if vals.get("current_step_id") and "date_due" not in vals:
+                vals["date_due"] = Step.browse(vals["current_step_id"])._get_due_date()
+        requests = super().create(vals_list)
+        requests._sync_approver_index()
+        return requests
+
+    def write(self, vals):
+        if "current_step_id" in vals:
+            step = self.env["dynamic.approval.rule.step"].browse(vals["current_step_id"])
+            now = fields.Datetime.now()
+            vals = dict(vals, is_escalated=False)
+            vals.setdefault("date_due", step._get_due_date(now) if step else False)
+            vals.setdefault("step_entered_date", now if step else False)
+        res = super().write(vals)
+        if {"state", "current_step_id", "is_escalated"}.intersection(vals):
+            self._sync_approver_index()
+        return res
+
+    def _sync_approver_index(self):
+        """ Bring the approver index rows of the given requests up to date: one row
+        per approver of the current step (escalation approvers included once
+        escalated) while pending, no row otherwise.
+
+        Only the rows that differ are deleted or inserted, so that refreshing many
+        requests after a small change, like a user joining an approver group,
+        writes one row per request concerned instead of rebuilding their index. """
+        if not self:
+            return
+        self.flush_recordset(["state", "current_step_id"])
+        self.flush_recordset(["is_escalated"])
+        self.env["dynamic.approval.rule.step"].flush_model(
+            ["approver_type", "user_id", "group_id", "escalation_user_id", "escalation_group_id"]
+        )
+        self.env["res.groups"].flush_model(["users"])
+        Index = self.env["approval.request.approver"]
+        expected = SQL(
+            """
+            SELECT req.id AS request_id, step.id AS step_id, step.user_id AS user_id
+              FROM %(request)s req
+              JOIN %(step)s step ON step.id = req.current_step_id
+             WHERE req.id = ANY(%(ids)s) AND req.state = 'pending'
+               AND step.approver_type = 'user' AND step.user_id IS NOT NULL
+             UNION
+            SELECT req.id, step.id, rel.uid
+              FROM %(request)s req
+              JOIN %(step)s step ON step.id = req.current_step_id
+              JOIN res_groups_users_rel rel ON rel.gid = step.group_id
+             WHERE req.id = ANY(%(ids)s) AND req.state = 'pending'
+               AND step.approver_type = 'group'
+             UNION
+            SELECT req.id, step.id, step.escalation_user_id
+              FROM %(request)s req
+              JOIN %(step)s step ON step.id = req.current_step_id
+             WHERE req.id = ANY(%(ids)s) AND req.state = 'pending'
+               AND req.is_escalated AND step.escalation_user_id IS NOT NULL
+             UNION
+            SELECT req.id, step.id, rel.uid
+              FROM %(request)s req
+              JOIN %(step)s step ON step.id = req.current_step_id
+              JOIN res_groups_users_rel rel ON rel.gid = step.escalation_group_id
+             WHERE req.id = ANY(%(ids)s) AND req.state = 'pending'
+               AND req.is_escalated
+            """,
+            request=SQL.identifier(self._table),
+            step=SQL.identifier(self.env["dynamic.approval.rule.step"]._table),
+            ids=self.ids,
+        )
+        self.env.cr.execute(SQL(
+            """
+            DELETE FROM %(index)s idx
+             WHERE idx.request_id = ANY(%(ids)s)
+               AND NOT EXISTS (
+                    SELECT 1 FROM (%(expected)s) expected
+                     WHERE expected.request_id = idx.request_id
+                       AND expected.step_id = idx.step_id
+                       AND expected.user_id = idx.user_id)
+            """,
+            index=SQL.identifier(Index._table), ids=self.ids, expected=expected,
+        ))
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO %(index)s (request_id, step_id, user_id)
+            SELECT expected.request_id, expected.step_id, expected.user_id
+              FROM (%(expected)s) expected
+                ON CONFLICT (request_id, user_id) DO NOTHING
+            """,
+            index=SQL.identifier(Index._table), expected=expected,
+        ))
+        Index.invalidate_model()
+        self.invalidate_recordset(["approver_index_ids", "current_approver_ids"])
+
+    @api.model
+    def _sync_approver_index_for_steps(self, steps):
+        """ Refresh the approver index of the pending requests waiting on ``steps``. """
+        if steps:
+            self.sudo().search([
+                ("state", "=", "pending"),
+                ("current_step_id", "in", steps.ids),
+            ])._sync_approver_index()
+
+    @api.model
+    def _sync_approver_index_for_groups(self, groups):
+        """ Refresh the approver index of the pending requests waiting on a step
+        approved by one of ``groups``, after their membership changed. """
+        if groups:
+            self._sync_approver_index_for_steps(self.env["dynamic.approval.rule.step"].sudo().search([
+                "|",
+                    "&", ("approver_type", "=", "group"), ("group_id", "in", groups.ids),
+                    ("escalation_group_id", "in", groups.ids),
+            ]))
+
     @api.depends("current_approver_ids")
     def _compute_can_user_approve(self):
         for req in self:
             req.can_user_approve = self.env.user in req.current_approver_ids
 
+    # --- Inbox --- #
+
+    @api.model
+    def get_approval_inbox(self, offset=0, limit=80):
+        """ Return the pending requests the current user can act on, one page at a
+        time, together with the number of such requests per model and rule.
+
+        Everything comes from a single query on the approver index.
+
+        :return: dict with keys ``total``, ``counts`` (list of dicts with
+            ``res_model``, ``rule_id``, ``rule_name`` and ``count``) and ``records``
+            (list of dicts with ``id``, ``name``, ``res_model``, ``res_id``,
+            ``rule_id``, ``step_name`` and ``request_date``)
+        """
+        Index = self.env["approval.request.approver"]
+        Index.flush_model()
+        self.flush_model(["name", "res_model", "res_id", "rule_id", "current_step_id", "request_date"])
+        self.env.cr.execute(SQL(
+            """
+            WITH pending AS (
+                SELECT req.id, req.name, req.res_model, req.res_id, req.rule_id, req.request_date,
+                       rule.name AS rule_name, step.name AS step_name
+                  FROM %(index)s idx
+                  JOIN %(request)s req ON req.id = idx.request_id
+                  JOIN %(rule)s rule ON rule.id = req.rule_id
+             LEFT JOIN %(step)s step ON step.id = req.current_step_id
+                 WHERE idx.user_id = %(uid)s
+            )
+            SELECT (SELECT count(*) FROM pending),
+                   (SELECT COALESCE(json_agg(grp), '[]')
+                      FROM (SELECT res_model, rule_id, rule_name, count(*) AS count
+                              FROM pending
+                          GROUP BY res_model, rule_id, rule_name
+                          ORDER BY res_model, rule_name) grp),
+                   (SELECT COALESCE(json_agg(page), '[]')
+                      FROM (SELECT id, name, res_model, res_id, rule_id, step_name, request_date
+                              FROM pending
+                          ORDER BY request_date DESC, id DESC
+                             LIMIT %(limit)s OFFSET %(offset)s) page)
+            """,
+            index=SQL.identifier(Index._table),
+            request=SQL.identifier(self._table),
+            rule=SQL.identifier(self.env["dynamic.approval.rule"]._table),
+            step=SQL.identifier(self.env["dynamic.approval.rule.step"]._table),
+            uid=self.env.uid,
+            limit=limit,
+            offset=offset,
+        ))
+        total, counts, records = self.env.cr.fetchone()
+        return {"total": total, "counts": counts, "records": records}
+
+    @api.model
+    def get_pending_approval_count(self):
+        """ Return the number of requests waiting for the current user, counted
+        with an index-only scan of the approver index; cheap enough to be polled
+        by a systray badge, and without a shared row to update on every decision. """
+        Index = self.env["approval.request.approver"]
+        Index.flush_model(["user_id"])
+        self.env.cr.execute(SQL(
+            "SELECT count(*) FROM %s WHERE user_id = %s",
+            SQL.identifier(Index._table), self.env.uid,
+        ))
+        return self.env.cr.fetchone()[0]
+
     # --- Action Methods --- #
 
     def action_approve(self):
-        self.ensure_one()
-        if not self.can_user_approve:
-            raise UserError(_("You are not authorized to approve this request at the current step."))
-        if self.state != "pending":
-            raise UserError(_("This request is not in a pending state."))
+        self._check_can_decide(_("You are not authorized to approve this request at the current step."))
 
         self._create_log_entry("approved")
-        next_step = self._find_next_step()
+        requests_by_next_step = {}
+        to_close = self.browse()
+        for requests in self.grouped(lambda req: (req.rule_id, req.current_step_id)).values():
+            next_step = requests[:1]._find_next_step()
+            if next_step:
+                requests_by_next_step[next_step] = requests_by_next_step.get(next_step, self.browse()) | requests
+            else:
+                to_close |= requests
+
+        for next_step, requests in requests_by_next_step.items():
+            requests.write({"current_step_id": next_step.id})
+        self.browse().union(*requests_by_next_step.values())._notify_approvers()
 
-        if next_step:
-            self.write({"current_step_id": next_step.id})
-            self._notify_approvers(next_step)
-        else:
-            self.write({"state": "approved", "current_step_id": False})
-            self._trigger_original_method() # The core logic!
-            self._notify_requester("approved")
-            self._clear_activities()
+        if to_close:
+            to_close.write({"state": "approved", "current_step_id": False, "date_closed": fields.Datetime.now()})
+            to_close._trigger_original_method() # The core logic!
+            to_close._notify_requester("approved")
+            to_close._clear_activities()
 
     def action_reject(self):
-        self.ensure_one()
-        if not self.can_user_approve:
-            raise UserError(_("You are not authorized to reject this request at the current step."))
-        if self.state != "pending":
-            raise UserError(_("This request is not in a pending state."))
+        self._check_can_decide(_("You are not authorized to reject this request at the current step."))
         
         # TODO: Add a wizard to ask for rejection reason?
-        rejection_reason = "Rejected by user."
+        self._reject("Rejected by user.")
+
+    def _reject(self, rejection_reason):
         self._create_log_entry("rejected", reason=rejection_reason)
-        self.write({"state": "rejected", "current_step_id": False})
+        self.write({"state": "rejected", "current_step_id": False, "date_closed": fields.Datetime.now()})
         self._notify_requester("rejected", reason=rejection_reason)
         self._clear_activities()
 
+    def _check_can_decide(self, message):
+        """ Raise ``message`` unless the current user can decide on all requests of ``self``. """
+        if not all(req.can_user_approve for req in self):
+            raise UserError(message)
+        if any(req.state != "pending" for req in self):
+            raise UserError(_("This request is not in a pending state."))
 
     def _create_log_entry(self, decision, reason=None):
-        self.ensure_one()
-        self.env["approval.request.log"].sudo().create({
-            "request_id": self.id,
-            "step_id": self.current_step_id.id,
+        """ Log ``decision`` on the requests, and update their decision summary. """
+        now = fields.Datetime.now()
+        self.env["approval.request.log"].sudo().create([{
+            "request_id": req.id,
+            "step_id": req.current_step_id.id,
             "decision": decision,
-            "decision_date": fields.Datetime.now(),
+            "decision_date": now,
             "user_id": self.env.user.id,
             "reason": reason,
-        })
+        } for req in self])
+
+        summary = {
+            "last_decision": decision,
+            "last_decision_user_id": self.env.user.id,
+            "last_decision_date": now,
+        }
+        if decision == "rejected":
+            summary["rejection_reason"] = reason
+        if decision != "approved":
+            self.sudo().write(summary)
+            return
+        for steps_completed, requests in self.grouped("steps_completed").items():
+            requests.sudo().write(dict(summary, steps_completed=steps_completed + 1))
 
     def _find_next_step(self):
         self.ensure_one()
-        current_sequence = self.current_step_id.sequence
-        next_step = self.env["dynamic.approval.rule.step"].search([
-            ("rule_id", "=", self.rule_id.id),
-            ("sequence", ">", current_sequence)
-        ], order="sequence asc", limit=1)
-        return next_step
+        return self.current_step_id.next_step_id
 
     def _trigger_original_method(self):
-        """ This is where the magic happens after approval. Needs careful implementation. """
-        self.ensure_one()
-        _logger.info(f"Approval granted for {self.res_model} {self.res_id}, method {self.rule_id.method_name}. Triggering original method.")
-        record = self.env[self.res_model].browse(self.res_id)
-        # How to call the original method safely?
-        # This requires the patching mechanism to store the original method
-        # and provide a way to call it, bypassing the wrapper for this specific record.
-        # Placeholder for now.
-        try:
-            # We need access to the original arguments (*args, **kwargs) if any were passed.
-            # This is a major challenge - how to store/retrieve them?
-            # Maybe the wrapper needs to store them on the request?
-            
-            # Simplistic approach for methods without args for now:
-            # getattr(record, self.rule_id.method_name)()
-            
-            # A more robust approach might involve a flag or context:
-            record.with_context(bypass_dynamic_approval=self.rule_id.id).mapped(self.rule_id.method_name)
-            
-            # Post a success message?
-            record.message_post(body=_(f"Action '{self.rule_id.method_name}' executed after approval."))
+        """ Queue the replay of the intercepted method for the approved requests;
+        the execution cron runs it in batches. """
+        self.write({"exec_state": "queued", "exec_next_date": fields.Datetime.now(), "exec_error": False})
+        self.env.ref(f"{self._module}.ir_cron_execute_approved_requests")._trigger()
 
-        except Exception as e:
-            _logger.error(f"Error triggering original method {self.rule_id.method_name} for {self.res_model} {self.res_id}: {e}")
-            # Maybe notify the user?
-            self.message_post(
-                body=_("⚠️ Failed to execute action '%s' after approval. Error: %s" % (self.rule_id.method_name, e))
-            )
+    @api.model
+    def _cron_execute_approved(self, batch_size=200):
+        """ Replay the methods of the approved requests, committing after each batch. """
+        auto_commit = not getattr(threading.current_thread(), "testing", False)
+        while True:
+            requests = self.search([
+                ("exec_state", "=", "queued"),
+                ("exec_next_date", "<=", fields.Datetime.now()),
+            ], order="exec_next_date, id", limit=batch_size)
+            if not requests:
+                break
+            requests._execute_original_method()
+            if auto_commit:
+                self.env.cr.commit()
 
-    def _notify_approvers(self, step_to_notify):
-        self.ensure_one()
-        approvers = self.env["res.users"]
-        if step_to_notify.approver_type == "user":
-            approvers = step_to_notify.user_id
-        elif step_to_notify.approver_type == "group":
-            approvers = step_to_notify.group_id.users
-        
-        if approvers:
-            record_ref = self.resource_ref
-            for approver in approvers:
-                self.activity_schedule(
-                    "mail.mail_activity_data_todo",
-                    user_id=approver.id,
-                    note=_("Please approve %s for %s.") % (record_ref.display_name if record_ref else f"{self.res_model}/{self.res_id}", step_to_notify.name),
-                    summary=_("Approval Required"),
+    def _execute_original_method(self):
+        """ Run the intercepted method on the approved documents, bypassing the
+        approval wrapper. Requests sharing model, method, arguments and requester
+        are replayed with a single call on the combined recordset; if that call
+        fails, they are replayed one by one, so that a single failing document
+        does not hold back the others. """
+        for (res_model, method_name, call_args, user), requests in self.grouped(
+            lambda req: (req.res_model, req.rule_id.method_name, req.call_args or "", req.origin_user_id)
+        ).items():
+            _logger.info(f"Approval granted for {res_model} {requests.mapped('res_id')}, method {method_name}. Triggering original method.")
+            call = json.loads(call_args) if call_args else {}
+            error = requests._replay_original_method(res_model, method_name, call, user)
+            if error is None:
+                continue
+            if len(requests) == 1:
+                requests._schedule_retry(error)
+                continue
+            _logger.warning(f"Replaying {method_name} on {res_model} {requests.mapped('res_id')} one document at a time")
+            for req in requests:
+                error = req._replay_original_method(res_model, method_name, call, user)
+                if error is not None:
+                    req._schedule_retry(error)
+
+    def _replay_original_method(self, res_model, method_name, call, user):
+        """ Call ``method_name`` once on the documents of the requests, in a savepoint,
+        and mark the requests as executed if it succeeds.
+
+        :return: ``None`` on success, the error message otherwise
+        """
+        records = self.env[res_model].with_user(user or self.env.user).browse(self.mapped("res_id"))
+        start = time.perf_counter()
+        try:
+            with self.env.cr.savepoint():
+                getattr(records.with_context(bypass_dynamic_approval=True), method_name)(
+                    *call.get("args", []), **call.get("kwargs", {})
                 )
-            # TODO: Add email notifications?
+        except Exception as e:
+            _logger.error(f"Error triggering original method {method_name} for {res_model} {records.ids}: {e}")
+            return str(e)
+
+        duration = time.perf_counter() - start
+        for attempts, done_requests in self.grouped(lambda req: req.exec_attempts + 1).items():
+            done_requests.write({
+                "exec_state": "done",
+                "exec_date": fields.Datetime.now(),
+                "exec_duration": duration,
+                "exec_attempts": attempts,
+                "exec_next_date": False,
+                "exec_error": False,
+            })
+        if hasattr(records, "message_post"):
+            for record in records.sudo():
+                record.message_post(body=_("Action '%s' executed after approval.", method_name))
+        return None
+
+    def _schedule_retry(self, error):
+        """ Reschedule a failed replay with an exponential backoff, or give up after
+        EXEC_MAX_ATTEMPTS attempts. """
+        now = fields.Datetime.now()
+        for attempts, requests in self.grouped(lambda req: req.exec_attempts + 1).items():
+            if attempts >= EXEC_MAX_ATTEMPTS:
+                requests.write({"exec_state": "failed", "exec_attempts": attempts, "exec_next_date": False, "exec_error": error})
+                for req in requests:
+                    req.message_post(
+                        body=_("⚠️ Failed to execute action '%s' after approval. Error: %s", req.rule_id.method_name, error)
+                    )
+            else:
+                delay = timedelta(minutes=EXEC_RETRY_DELAY_MINUTES * 2 ** (attempts - 1))
+                requests.write({"exec_attempts": attempts, "exec_next_date": now + delay, "exec_error": error})
+
+    def action_retry_execution(self):
+        """ Queue failed replays again. """
+        failed = self.filtered(lambda req: req.exec_state == "failed")
+        failed.write({"exec_attempts": 0})
+        failed._trigger_original_method()
+
+    # --- SLA --- #
+
+    @api.model
+    def _cron_process_overdue(self, batch_size=500, max_batches=20):
+        """ Apply the overdue action of their step to the pending requests past
+        their due date, committing after each batch. Stops after ``max_batches``
+        batches and triggers itself again, to stay within the cron timeout. """
+        auto_commit = not getattr(threading.current_thread(), "testing", False)
+        for _batch in range(max_batches):
+            requests = self.search([
+                ("state", "=", "pending"),
+                ("date_due", "<=", fields.Datetime.now()),
+            ], order="date_due, id", limit=batch_size)
+            if not requests:
+                return
+            requests._process_overdue()
+            if auto_commit:
+                self.env.cr.commit()
+        self.env.ref(f"{self._module}.ir_cron_process_overdue_requests")._trigger()
+
+    def _process_overdue(self):
+        for step, requests in self.grouped("current_step_id").items():
+            action = step.sla_action
+            if action == "escalate" and not step._get_escalation_approvers():
+                action = "remind"
+            if action == "reject":
+                requests._reject(_("Rejected automatically: the approval deadline of %s was exceeded.", step.name))
+            elif action == "escalate":
+                requests.write({"is_escalated": True, "date_due": False})
+                requests._notify_approvers(escalation=True)
+            else:
+                requests.write({"date_due": step._get_due_date()})
+                requests._notify_approvers()
+
+    # --- Retention --- #
+
+    @api.model
+    def _cron_archive_closed_requests(self, batch_size=500):
+        """ Move the closed requests older than the retention of their rule to the
+        archive, committing after each batch. """
+        auto_commit = not getattr(threading.current_thread(), "testing", False)
+        rules = self.env["dynamic.approval.rule"].with_context(active_test=False).search([("retention_days", ">", 0)])
+        for rule in rules:
+            limit_date = fields.Datetime.now() - timedelta(days=rule.retention_days)
+            while True:
+                requests = self.search([
+                    ("rule_id", "=", rule.id),
+                    ("state", "in", ("approved", "rejected", "cancel")),
+                    ("exec_state", "!=", "queued"),
+                    "|", ("date_closed", "<", limit_date),
+                         "&", ("date_closed", "=", False), ("write_date", "<", limit_date),
+                ], limit=batch_size)
+                if not requests:
+                    break
+                requests._archive_requests()
+                if auto_commit:
+                    self.env.cr.commit()
+
+    def _archive_requests(self):
+        """ Copy the requests and their logs to compact archive rows, then delete
+        them along with their logs, messages, followers and activities. """
+        self.env["approval.request.archive"].create([{
+            "request_id": req.id,
+            "name": req.name,
+            "rule_id": req.rule_id.id,
+            "rule_name": req.rule_id.name,
+            "res_model": req.res_model,
+            "res_id": req.res_id,
+            "origin_user_id": req.origin_user_id.id,
+            "state": req.state,
+            "request_date": req.request_date,
+            "date_closed": req.date_closed or req.write_date,
+            "rejection_reason": req.rejection_reason,
+            "log_data": json.dumps([{
+                "date": fields.Datetime.to_string(log.decision_date),
+                "step": log.step_id.name,
+                "user_id": log.user_id.id,
+                "decision": log.decision,
+                "reason": log.reason,
+            } for log in req.log_ids.sorted("decision_date")]),
+        } for req in self])
+        self.unlink()
+
+    def _notify_approvers(self, step_to_notify=None, escalation=False):
+        """ Schedule an approval activity for every approver of ``step_to_notify``
+        (the current step of each request by default), in a single batch. With
+        ``escalation``, notify the escalation approvers of the step instead.
+
+        For requests whose rule is in digest mode, the shared work item of the
+        approvers is the request itself, listed in their approval inbox through
+        the approver index, and the periodic digest reminds them of it: only a
+        step with a single approver gets an activity. """
+        activity_type = self.env.ref("mail.mail_activity_data_todo")
+        res_model_id = self.env["ir.model"]._get_id(self._name)
+        date_deadline = activity_type._get_date_deadline()
+        activity_vals_list = []
+        for step, requests in self.grouped(lambda req: step_to_notify or req.current_step_id).items():
+            approvers = step._get_escalation_approvers() if escalation else step._get_approvers()
+            if not approvers:
+                continue
+            for req in requests:
+                note = _("Please approve %s for %s.") % (req.res_name, step.name)
+                values = {
+                    "activity_type_id": activity_type.id,
+                    "automated": True,
+                    "date_deadline": date_deadline,
+                    "note": note,
+                    "res_id": req.id,
+                    "res_model_id": res_model_id,
+                    "summary": _("Approval Required"),
+                }
+                if req.rule_id.notification_mode == "digest":
+                    if len(approvers) == 1:
+                        activity_vals_list.append(dict(values, user_id=approvers.id))
+                else:
+                    activity_vals_list.extend(dict(values, user_id=approver.id) for approver in approvers)
+        if activity_vals_list:
+            self.env["mail.activity"].sudo().create(activity_vals_list)
 
     def _notify_requester(self, status, reason=None):
-        self.ensure_one()
-        record_ref = self.resource_ref
-        doc_name = record_ref.display_name if record_ref else f"{self.res_model}/{self.res_id}"
-
-        if status == "approved":
-            message = _("Your request to approve %s has been fully approved.") % doc_name
-        elif status == "rejected":
-            message = _("Your request to approve %s has been rejected.") % doc_name
-            if reason:
-                message += _(" Reason: %s") % reason
-        else:
-            message = _("Your request for %s has been updated.") % doc_name
-
-        # Notify via internal message
-        self.env['mail.message'].sudo().create({
-            'author_id': self.env.user.partner_id.id,
-            'model': 'res.users',
-            'res_id': self.origin_user_id.id,
-            'message_type': 'notification',
-            'subtype_id': self.env.ref('mail.mt_note').id,
-            'body': message,
-        })
-
-        self.message_post(body=message)
+        """ Tell the requesters about the outcome of their requests: right away in
+        activity mode, through the periodic digest in digest mode. The decision is
+        logged once in the request's chatter either way. """
+        digest_vals_list = []
+        for req in self:
+            doc_name = req.res_name
+            if status == "approved":
+                message = _("Your request to approve %s has been fully approved.") % doc_name
+            elif status == "rejected":
+                message = _("Your request to approve %s has been rejected.") % doc_name
+                if reason:
+                    message += _(" Reason: %s") % reason
+            else:
+                message = _("Your request for %s has been updated.") % doc_name
+
+            if req.rule_id.notification_mode == "digest":
+                req.message_post(body=message)
+                digest_vals_list.append({"user_id": req.origin_user_id.id, "request_id": req.id, "body": message})
+            else:
+                req.message_post(body=message, partner_ids=req.origin_user_id.partner_id.ids)
+        if digest_vals_list:
+            self.env["approval.notification.digest"].sudo().create(digest_vals_list)
 
     def _clear_activities(self):
         self.activity_unlink(["mail.mail_activity_data_todo"]) # Clear approval activities
 
 
+class ApprovalRequestApprover(models.Model):
+    """ Compact index of who can act on which pending request, one row per request and user. """
+    _name = "approval.request.approver"
+    _description = "Approval Request Approver"
+    _log_access = False
+
+    request_id = fields.Many2one("approval.request", string="Request", required=True, ondelete="cascade")
+    step_id = fields.Many2one("dynamic.approval.rule.step", string="Step", ondelete="cascade")
+    user_id = fields.Many2one("res.users", string="Approver", required=True, ondelete="cascade")
+
+    _sql_constraints = [
+        ("request_user_uniq", "UNIQUE(request_id, user_id)", "A user can only be indexed once per request.")
+    ]
+
+    def init(self):
+        super().init()
+        # "Requests actionable by user X" is a single index lookup
+        tools.create_index(self.env.cr, "approval_request_approver_user_request_idx", self._table, ["user_id", "request_id"])
+
+
 class ApprovalRequestLog(models.Model):
     """ Logs the history of decisions for an approval request. """
     _name = "approval.request.log"
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models, tools
+from odoo.tools import SQL
+
+
+class ApprovalRequestArchive(models.Model):
+    """ Compact copy of a closed approval request, kept after the request, its
+    logs and its chatter were removed by the retention cron. """
+    _name = "approval.request.archive"
+    _description = "Archived Approval Request"
+    _order = "date_closed desc, id desc"
+
+    request_id = fields.Integer(string="Original Request ID", readonly=True, index=True)
+    name = fields.Char(string="Request Name", readonly=True)
+    rule_id = fields.Many2one("dynamic.approval.rule", string="Triggering Rule", readonly=True, ondelete="set null")
+    rule_name = fields.Char(string="Rule Name", readonly=True)
+    res_model = fields.Char(string="Resource Model Name", readonly=True)
+    res_id = fields.Integer(string="Resource ID", readonly=True)
+    origin_user_id = fields.Many2one("res.users", string="Requested By", readonly=True, ondelete="set null")
+    state = fields.Selection([
+        ("approved", "Approved"),
+        ("rejected", "Rejected"),
+        ("cancel", "Cancelled"),
+    ], string="Status", readonly=True)
+    request_date = fields.Datetime(string="Requested On", readonly=True)
+    date_closed = fields.Datetime(string="Closed On", readonly=True)
+    rejection_reason = fields.Text(string="Rejection Reason", readonly=True)
+    log_data = fields.Text(string="Approval Log", readonly=True, help="JSON list of the decisions taken on the request.")
+
+    def init(self):
+        super().init()
+        # Looked up by the interceptor for the documents whose requests were all archived
+        tools.drop_index(self.env.cr, "approval_request_archive_res_idx", self._table)
+        tools.create_index(self.env.cr, "approval_request_archive_res_rule_idx", self._table,
+                           ["res_model", "res_id", "rule_id"])
+
+    @api.model
+    def _get_latest_archives(self, res_model, rule_res_ids):
+        """ Fetch the latest archived request of each ``(rule_id, res_id)`` pair in
+        one query, like :meth:`approval.request._get_latest_requests`. """
+        self.flush_model(["res_model", "res_id", "rule_id", "request_id"])
+        rule_ids, res_ids = zip(*rule_res_ids, strict=True)
+        self.env.cr.execute(SQL(
+            """
+            SELECT DISTINCT ON (arch.res_id, arch.rule_id) arch.id, arch.rule_id, arch.res_id
+              FROM %s arch
+              JOIN unnest(%s::int[], %s::int[]) AS pair(rule_id, res_id)
+                ON pair.rule_id = arch.rule_id AND pair.res_id = arch.res_id
+             WHERE arch.res_model = %s
+          ORDER BY arch.res_id, arch.rule_id, arch.request_id DESC, arch.id DESC
+            """,
+            SQL.identifier(self._table), list(rule_ids), list(res_ids), res_model,
+        ))
+        rows = self.env.cr.fetchall()
+        archives = self.browse([row[0] for row in rows])
+        return {(rule_id, res_id): archive for archive, (_id, rule_id, res_id) in zip(archives, rows, strict=True)}
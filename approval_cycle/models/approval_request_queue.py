@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+
+import psycopg2
+
+from odoo import api, fields, models, tools
+from odoo.tools import SQL
+
+_logger = logging.getLogger(__name__)
+
+
+class ApprovalRequestQueue(models.Model):
+    """ Approval requests waiting to be created.
+
+    The interceptor cannot create requests in the caller's transaction, since it
+    raises right after to block the method. Payloads are written here through a
+    short-lived cursor instead, and a cron turns them into requests in batches.
+    """
+    _name = "approval.request.queue"
+    _description = "Approval Request Queue"
+    _order = "id"
+
+    rule_id = fields.Many2one("dynamic.approval.rule", string="Rule", required=True, ondelete="cascade")
+    res_model = fields.Char(string="Resource Model Name", required=True)
+    res_id = fields.Integer(string="Resource ID", required=True)
+    step_id = fields.Many2one("dynamic.approval.rule.step", string="First Step", ondelete="cascade")
+    origin_user_id = fields.Many2one("res.users", string="Requested By", ondelete="cascade")
+    call_args = fields.Text(string="Call Arguments", help="JSON-serialized arguments of the intercepted call.")
+
+    def init(self):
+        super().init()
+        # A document is queued at most once per rule, whatever the number of concurrent interceptions
+        if not tools.index_exists(self.env.cr, "approval_request_queue_record_uniq"):
+            self.env.cr.execute(SQL(
+                """
+                DELETE FROM %(table)s entry
+                 USING %(table)s older
+                 WHERE older.rule_id = entry.rule_id AND older.res_model = entry.res_model
+                   AND older.res_id = entry.res_id AND older.id < entry.id
+                """,
+                table=SQL.identifier(self._table),
+            ))
+            self.env.cr.execute(SQL(
+                "CREATE UNIQUE INDEX approval_request_queue_record_uniq ON %s (rule_id, res_model, res_id)",
+                SQL.identifier(self._table),
+            ))
+
+    @api.model
+    def _enqueue(self, vals_list):
+        """ Insert the given payloads with a dedicated cursor, so they survive the
+        rollback of the current transaction, and wake up the queue cron.
+
+        The insert is committed asynchronously: the caller neither commits its own
+        transaction nor waits for the WAL flush.
+
+        Payloads of documents that are already queued for the same rule are skipped
+        by the database, in the same round trip: concurrent interceptions of a
+        record never wait on each other's commit nor fail to serialize.
+
+        :return: set of the ``(rule_id, res_id)`` pairs actually queued
+        """
+        if not vals_list:
+            return set()
+        with self.env.registry.cursor() as cr:
+            cr.execute("SET LOCAL synchronous_commit TO OFF")
+            cr.execute(SQL(
+                """
+                INSERT INTO %s (rule_id, res_model, res_id, step_id, origin_user_id, call_args,
+                                create_uid, create_date, write_uid, write_date)
+                SELECT payload.rule_id, payload.res_model, payload.res_id, payload.step_id, payload.origin_user_id,
+                       payload.call_args, %s, now() AT TIME ZONE 'UTC', %s, now() AT TIME ZONE 'UTC'
+                  FROM unnest(%s::int[], %s::varchar[], %s::int[], %s::int[], %s::int[], %s::text[])
+                       AS payload(rule_id, res_model, res_id, step_id, origin_user_id, call_args)
+                    ON CONFLICT (rule_id, res_model, res_id) DO NOTHING
+                RETURNING rule_id, res_id
+                """,
+                SQL.identifier(self._table),
+                self.env.uid, self.env.uid,
+                [vals["rule_id"] for vals in vals_list],
+                [vals["res_model"] for vals in vals_list],
+                [vals["res_id"] for vals in vals_list],
+                [vals["step_id"] for vals in vals_list],
+                [vals["origin_user_id"] for vals in vals_list],
+                [vals.get("call_args") or None for vals in vals_list],
+            ))
+            queued = set(cr.fetchall())
+            if queued:
+                self.env(cr=cr).ref(f"{self._module}.ir_cron_process_approval_request_queue")._trigger()
+        return queued
+
+    @api.model
+    def _cron_process_queue(self, batch_size=500):
+        """ Create the queued approval requests, committing after each batch. """
+        auto_commit = not getattr(threading.current_thread(), "testing", False)
+        while True:
+            entries = self.search([], limit=batch_size)
+            if not entries:
+                break
+            entries._create_requests()
+            entries.unlink()
+            if auto_commit:
+                self.env.cr.commit()
+
+    def _create_requests(self):
+        """ Turn queue entries into approval requests, skipping the records that
+        already have a pending request for the same rule. Entries are unique per
+        rule and document, which the database enforces on both tables; an entry
+        conflicting with a pending request is skipped rather than failing the batch. """
+        Request = self.env["approval.request"].sudo()
+        vals_list = []
+        for res_model, entries in self.grouped("res_model").items():
+            # The payload outlives the caller's transaction: drop the documents that
+            # were created in it, or deleted since
+            existing_ids = set()
+            if res_model in self.env:
+                existing_ids = set(self.env[res_model].browse(entries.mapped("res_id")).exists()._ids)
+            missing = entries.filtered(lambda entry, existing_ids=existing_ids: entry.res_id not in existing_ids)
+            if missing:
+                _logger.info("Dropped %s queued approval request(s) for missing %s records", len(missing), res_model)
+                entries -= missing
+            pending_keys = {
+                (request.rule_id.id, request.res_id)
+                for request in Request.search([
+                    ("state", "=", "pending"),
+                    ("res_model", "=", res_model),
+                    ("res_id", "in", entries.mapped("res_id")),
+                    ("rule_id", "in", entries.rule_id.ids),
+                ])
+            }
+            for entry in entries:
+                if (entry.rule_id.id, entry.res_id) in pending_keys:
+                    continue
+                vals_list.append({
+                    "rule_id": entry.rule_id.id,
+                    "res_id": entry.res_id,
+                    "origin_user_id": entry.origin_user_id.id,
+                    "current_step_id": entry.step_id.id,
+                    "call_args": entry.call_args,
+                })
+        try:
+            with self.env.cr.savepoint():
+                requests = Request.create(vals_list)
+        except psycopg2.IntegrityError:
+            # A pending request was created meanwhile for some of the documents:
+            # create the others one by one, so that the conflicting entries do
+            # not block the queue
+            requests = Request
+            for vals in vals_list:
+                try:
+                    with self.env.cr.savepoint():
+                        requests |= Request.create(vals)
+                except psycopg2.IntegrityError:
+                    _logger.info("Skipped queued approval request for %s %s, rule %s: already pending",
+                                 Request.env["dynamic.approval.rule"].browse(vals["rule_id"]).model_name,
+                                 vals["res_id"], vals["rule_id"])
+        requests._notify_approvers()
+        _logger.info("Created %s approval request(s) from %s queued entries", len(requests), len(self))
+        return requests
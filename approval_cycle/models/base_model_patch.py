@@ -1,164 +1,438 @@
 # -*- coding: utf-8 -*-
+import ast
+import contextlib
+import json
 import logging
 import functools
+import random
+import threading
+import time
+from collections import defaultdict, namedtuple
 from odoo import api, models, SUPERUSER_ID, _
 from odoo.exceptions import UserError
+from odoo.tools import split_every
+from odoo.tools.profiler import Profiler
 from odoo.tools.safe_eval import safe_eval
 from odoo.api import Environment
 
 _logger = logging.getLogger(__name__)
 _log_prefix = "[DynamicApprovalPatch]"
 
-_original_methods = {}
+# Methods wrapped by the interceptor, as (model, method) keys per database; the
+# original methods are kept by the wrappers themselves, in ``__wrapped__``
+_patched_methods = defaultdict(set)
+
+# Compiled rule domains, keyed by (database, rule id) and tagged with the rule's write_date
+_compiled_domains = {}
+
+# Interceptor metrics of this process, keyed by (database, model, method, rule id or 0
+# for the call totals), and periodically added to approval.interceptor.metric
+_metrics = defaultdict(lambda: defaultdict(float))
+_metrics_state = {"last_flush": time.monotonic()}
+_metrics_lock = threading.Lock()
+METRICS_FLUSH_INTERVAL = 60  # seconds
+
+# Records checked at once by the interceptor, unless set by a system parameter
+INTERCEPT_CHUNK_SIZE = 1000
+# Records listed in the message of a blocked call
+QUEUED_SAMPLE_SIZE = 20
+
+CompiledDomain = namedtuple("CompiledDomain", ["source", "domain", "uses_record"])
+
+
+def _compile_domain(source):
+    """ Parse a rule domain once. Domains that do not reference ``record`` are
+    evaluated right away; the others are kept as source and evaluated per record. """
+    tree = ast.parse(source.strip(), mode="eval")
+    uses_record = any(isinstance(node, ast.Name) and node.id == "record" for node in ast.walk(tree))
+    domain = None if uses_record else safe_eval(source)
+    return CompiledDomain(source, domain, uses_record)
+
+
+def _get_compiled_domain(env, rule_entry, metrics=None):
+    """ Return the :class:`CompiledDomain` of a rule index entry, reusing the cached
+    one as long as the rule and its domain have not changed since: the write date
+    alone misses the writes made within the same transaction, which share it.
+    Cache hits and misses are counted in ``metrics``, if given. """
+    key = (env.cr.dbname, rule_entry.id)
+    cached = _compiled_domains.get(key)
+    if cached and cached[0] == rule_entry.write_date and cached[1].source == rule_entry.domain:
+        if metrics is not None:
+            metrics["domain_cache_hits"] += 1
+        return cached[1]
+    if metrics is not None:
+        metrics["domain_cache_misses"] += 1
+    compiled = _compile_domain(rule_entry.domain)
+    _compiled_domains[key] = (rule_entry.write_date, compiled)
+    return compiled
+
+
+def _evaluate_domain(compiled, record):
+    """ Return the domain to apply on ``record``. """
+    if compiled.uses_record:
+        return safe_eval(compiled.source, {"record": record})
+    return compiled.domain
+
+
+def _new_call_metrics(cr):
+    """ Return the metrics accumulator of one intercepted call. """
+    metrics = defaultdict(float)
+    metrics["query_start"] = cr.sql_log_count
+    metrics["start"] = time.perf_counter()
+    metrics["rules"] = defaultdict(lambda: defaultdict(float))
+    return metrics
+
+
+@contextlib.contextmanager
+def _timed(metrics, key):
+    """ Add the time spent in the block to ``metrics[key]``. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics[key] += time.perf_counter() - start
+
+
+def _record_call_metrics(env, model_name, method_name, metrics):
+    """ Add the metrics of one intercepted call to the process-wide metrics.
+    Never raises: metrics must not make the intercepted call fail. """
+    try:
+        dbname = env.cr.dbname
+        rule_metrics = metrics.pop("rules")
+        query_count = env.cr.sql_log_count - metrics.pop("query_start")
+        total_time = time.perf_counter() - metrics.pop("start")
+        with _metrics_lock:
+            totals = _metrics[(dbname, model_name, method_name, 0)]
+            totals["call_count"] += 1
+            totals["query_count"] += query_count
+            totals["total_time"] += total_time
+            for key, value in metrics.items():
+                totals[key] += value
+            for rule_id, values in rule_metrics.items():
+                rule_totals = _metrics[(dbname, model_name, method_name, rule_id)]
+                for key, value in values.items():
+                    rule_totals[key] += value
+        _flush_metrics(env)
+    except Exception as e:
+        _logger.warning("%s Failed to record interceptor metrics: %s", _log_prefix, e)
+
+
+def _flush_metrics(env, force=False):
+    """ Every METRICS_FLUSH_INTERVAL seconds, add the metrics collected by this
+    process to approval.interceptor.metric, through a separate cursor. """
+    now = time.monotonic()
+    if not force and now - _metrics_state["last_flush"] < METRICS_FLUSH_INTERVAL:
+        return
+    with _metrics_lock:
+        _metrics_state["last_flush"] = now
+        dbname = env.cr.dbname
+        pending = {key[1:]: dict(values) for key, values in _metrics.items() if key[0] == dbname}
+        for key in list(_metrics):
+            if key[0] == dbname:
+                del _metrics[key]
+    if not pending:
+        return
+    try:
+        with env.registry.cursor() as cr:
+            env(cr=cr, user=SUPERUSER_ID)["approval.interceptor.metric"]._accumulate(pending)
+    except Exception as e:
+        _logger.warning("%s Failed to store interceptor metrics: %s", _log_prefix, e)
+
+
+def _sampling_profiler(env, model_name, method_name):
+    """ Return a profiler for a sample of the intercepted calls, as set by the
+    ``dynamic_approval.profiler_sample_rate`` system parameter (between 0 and 1),
+    or a no-op context manager. """
+    rate = float(env["ir.config_parameter"].sudo().get_param("dynamic_approval.profiler_sample_rate") or 0)
+    if rate <= 0 or random.random() >= rate:
+        return contextlib.nullcontext()
+    return Profiler(db=env.cr.dbname, description=f"Approval interceptor {model_name}.{method_name}")
+
+
+def _is_stored_domain(model, domain):
+    """ Return whether every leaf of ``domain`` only goes through stored fields,
+    so the domain can be evaluated by a SQL search. """
+    for leaf in domain:
+        if isinstance(leaf, str):
+            continue  # domain operator
+        if not isinstance(leaf, (list, tuple)) or len(leaf) != 3 or not isinstance(leaf[0], str):
+            return False
+        current = model
+        for fname in leaf[0].split("."):
+            if current is None:
+                return False
+            field = current._fields.get(fname)
+            if field is None or not field.store:
+                return False
+            current = model.env[field.comodel_name] if field.relational else None
+    return True
+
+
+def _match_rules(records, applicable_rules, metrics=None):
+    """ Partition ``records`` by their first matching rule, in rule sequence order.
+
+    Static domains on stored fields are evaluated with one search per rule over
+    the remaining records; other domains fall back to Python evaluation.
+
+    :param records: recordset to check, in a superuser environment
+    :param applicable_rules: list of ``(RuleIndexEntry, CompiledDomain)``
+    :param metrics: optional call metrics, receiving per-rule timings and matches
+    :return: ``(matches, unmatched)`` where ``matches`` is a list of
+        ``(RuleIndexEntry, recordset)`` and ``unmatched`` the remaining records
+    """
+    remaining = records
+    matches = []
+    sql_capable = all(records._ids)  # new records cannot be searched
+    for entry, compiled in applicable_rules:
+        if not remaining:
+            break
+        start = time.perf_counter()
+        try:
+            if compiled.uses_record:
+                matched = remaining.filtered(
+                    lambda rec, compiled=compiled: rec.filtered_domain(_evaluate_domain(compiled, rec))
+                )
+            elif sql_capable and _is_stored_domain(remaining, compiled.domain):
+                # A domain failing in the database must not abort the caller's transaction
+                with remaining.env.cr.savepoint():
+                    found = remaining.with_context(active_test=False).search(
+                        [("id", "in", remaining.ids)] + list(compiled.domain)
+                    )
+                matched = remaining.browse(found.ids)
+            else:
+                matched = remaining.filtered_domain(compiled.domain)
+        except Exception as e:
+            _logger.error("%s Error evaluating domain for rule %s: %s", _log_prefix, entry.id, e)
+            continue
+        finally:
+            if metrics is not None:
+                metrics["rules"][entry.id]["domain_time"] += time.perf_counter() - start
+        if matched:
+            if metrics is not None:
+                metrics["rules"][entry.id]["match_count"] += len(matched)
+            matches.append((entry, matched))
+            remaining -= matched
+    return matches, remaining
+
+
+def _serialize_call_args(args, kwargs):
+    """ Serialize the arguments of an intercepted call, so the call can be replayed
+    once approved. Return ``False`` if they cannot be stored as JSON. """
+    try:
+        return json.dumps({"args": list(args), "kwargs": kwargs})
+    except (TypeError, ValueError):
+        return False
 
 
 def _create_dynamic_approval_wrapper(model_name, method_name, original_method):
     """ Creates a wrapper function for a specific method to handle dynamic approvals. """
-    _logger.debug(f"{_log_prefix} Creating wrapper for {model_name}.{method_name}")
+    _logger.debug("%s Creating wrapper for %s.%s", _log_prefix, model_name, method_name)
 
     @functools.wraps(original_method)
     def wrapper(self, *args, **kwargs):
-        _logger.debug(f"{_log_prefix} Wrapper called for {model_name}.{method_name} on records {self.ids}")
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug("%s Wrapper called for %s.%s on records %s", _log_prefix, model_name, method_name, self.ids)
 
         # Check context to bypass approval (used after approval is granted)
         if self.env.context.get('bypass_dynamic_approval'):
-            _logger.debug(f"{_log_prefix} Bypassing approval check due to context flag")
+            _logger.debug("%s Bypassing approval check due to context flag", _log_prefix)
             return original_method(self, *args, **kwargs)
 
-        # Use SUPERUSER to check rules and create requests to avoid access right issues
-        env_su = self.env(user=SUPERUSER_ID)
-        applicable_rules = env_su["dynamic.approval.rule"].search([
-            ("model_name", "=", model_name),
-            ("method_name", "=", method_name),
-            ("active", "=", True)
-        ], order="sequence asc")
+        metrics = _new_call_metrics(self.env.cr)
+        try:
+            with _sampling_profiler(self.env, model_name, method_name):
+                records_to_process = _check_approvals(self, model_name, method_name, args, kwargs, metrics)
+        finally:
+            _record_call_metrics(self.env, model_name, method_name, metrics)
 
-        if not applicable_rules:
-            _logger.debug(f"{_log_prefix} No active rules found, proceeding with original method")
+        if records_to_process is None:
             return original_method(self, *args, **kwargs)
 
-        _logger.info(f"{_log_prefix} Found {len(applicable_rules)} applicable rule(s)")
+        # Only process records that didn't need approval
+        if records_to_process:
+            if _logger.isEnabledFor(logging.DEBUG):
+                _logger.debug("%s Processing records: %s", _log_prefix, records_to_process.ids)
+            return original_method(records_to_process, *args, **kwargs)
 
-        # Process records one by one
-        records_to_process = self.env[model_name]
-        processed_record_ids = set()
-        approval_requests_created = []
+        return None
 
-        for record in self:
-            if record.id in processed_record_ids:
-                continue
+    return wrapper
 
-            _logger.debug(f"{_log_prefix} Processing record ID {record.id}")
-            record_needs_approval = False
-            triggered_rule = None
-
-            # Find first matching rule for this record
-            for rule in applicable_rules:
-                try:
-                    domain = safe_eval(rule.domain or "[]", {"record": record})
-                    if record.filtered_domain(domain):
-                        _logger.debug(f"{_log_prefix} Rule matched: {rule.name} (ID: {rule.id})")
-                        triggered_rule = rule
-                        record_needs_approval = True
-                        break
-                except Exception as e:
-                    _logger.error(f"{_log_prefix} Error evaluating domain for rule {rule.id}: {e}")
-                    continue
 
-            if not record_needs_approval:
-                _logger.debug(f"{_log_prefix} No matching rules, adding to process list")
-                processed_record_ids.add(record.id)
-                continue
+def _check_approvals(records, model_name, method_name, args, kwargs, metrics):
+    """ Check the approval rules of ``model_name.method_name`` on ``records``.
 
+    Queue approval requests and raise a :class:`UserError` if some records need
+    an approval they do not have yet.
+
+    :return: the records the original method may run on, or ``None`` if no rule
+        applies to the method at all
+    """
+    # Use SUPERUSER to check rules and create requests to avoid access right issues
+    env_su = records.env(user=SUPERUSER_ID)
+    with _timed(metrics, "rule_lookup_time"):
+        rule_index = env_su["dynamic.approval.rule"]._get_rule_index(model_name, method_name)
+
+        if not rule_index:
+            _logger.debug("%s No active rules found, proceeding with original method", _log_prefix)
+            return None
+
+        _logger.debug("%s Found %s applicable rule(s)", _log_prefix, len(rule_index))
+        applicable_rules = []
+        for entry in rule_index:
+            try:
+                applicable_rules.append((entry, _get_compiled_domain(env_su, entry, metrics)))
+            except Exception as e:
+                _logger.error("%s Error parsing domain for rule %s: %s", _log_prefix, entry.id, e)
+
+    call_args = _serialize_call_args(args, kwargs)
+    if call_args is False:
+        _logger.warning("%s Arguments of %s.%s cannot be stored, the method will be replayed "
+                        "without arguments after approval", _log_prefix, model_name, method_name)
+
+    # Stream through the records in chunks, so that the cache stays bounded whatever
+    # the size of the recordset. Every chunk is checked before anything is queued:
+    # a call blocked by an existing request must not submit requests for the others.
+    chunk_size = _get_chunk_size(env_su)
+    to_queue = []
+    for ids in split_every(chunk_size, records._ids):
+        chunk = records.browse(ids).with_env(env_su)
+        to_queue += _check_approvals_chunk(chunk, model_name, applicable_rules, metrics)
+        chunk.invalidate_recordset()
+
+    if to_queue:
+        # The requests are written through a separate cursor, so that they survive
+        # the rollback caused by the UserError below without committing the caller.
+        queued_count = 0
+        try:
+            with _timed(metrics, "request_creation_time"):
+                for batch in split_every(chunk_size, to_queue):
+                    queued_count += len(env_su["approval.request.queue"]._enqueue([{
+                        'rule_id': rule_id,
+                        'res_model': model_name,
+                        'res_id': res_id,
+                        'step_id': step_id,
+                        'origin_user_id': records.env.uid,
+                        'call_args': call_args,
+                    } for rule_id, res_id, step_id in batch]))
+        except Exception as e:
+            _logger.error("%s Failed to queue approval requests: %s", _log_prefix, e, exc_info=True)
+            raise UserError(_(
+                "Failed to create approval request.\n"
+                "Error details: %s\n\n"
+                "Please contact your administrator.") % str(e)) from e
+        # Records already queued by a concurrent call are skipped by the queue, and
+        # reported as submitted all the same
+        _logger.info("%s Queued %s approval request(s) for %s (%s already queued)",
+                     _log_prefix, queued_count, model_name, len(to_queue) - queued_count)
+        sample = to_queue[:QUEUED_SAMPLE_SIZE]
+        sample_records = env_su[model_name].browse([res_id for _rule_id, res_id, _step_id in sample])
+        sample_rules = env_su["dynamic.approval.rule"].browse([rule_id for rule_id, _res_id, _step_id in sample])
+        requests_list = "\n".join(
+            f"- {record.display_name} ({rule.name})"
+            for record, rule in zip(sample_records, sample_rules, strict=True)
+        )
+        if len(to_queue) > QUEUED_SAMPLE_SIZE:
+            requests_list += "\n" + _("... and %s more", len(to_queue) - QUEUED_SAMPLE_SIZE)
+        raise UserError(_(
+            "Action requires approval. Approval requests have been submitted for:\n\n"
+            "%s\n\n"
+            "The approvers will be notified. You'll receive a notification once processed."
+        ) % requests_list)
+
+    # Every record either passes or makes the call raise above: the records that
+    # may proceed are the recordset itself
+    return records
+
+
+def _get_chunk_size(env):
+    """ Return the number of records checked at once by the interceptor, as set by
+    the ``dynamic_approval.intercept_chunk_size`` system parameter. """
+    try:
+        chunk_size = int(env["ir.config_parameter"].get_param("dynamic_approval.intercept_chunk_size") or 0)
+    except ValueError:
+        chunk_size = 0
+    return chunk_size if chunk_size > 0 else INTERCEPT_CHUNK_SIZE
+
+
+def _check_approvals_chunk(chunk, model_name, applicable_rules, metrics):
+    """ Check the approval rules on a chunk of records, in a superuser environment.
+
+    Raise a :class:`UserError` if a record has a pending or rejected request.
+
+    :return: list of ``(rule_id, res_id, step_id)`` of the approval requests to
+        queue for the chunk
+    """
+    env_su = chunk.env
+    metrics["record_count"] += len(chunk)
+    with _timed(metrics, "domain_time"):
+        matches, _unmatched = _match_rules(chunk, applicable_rules, metrics=metrics)
+    with _timed(metrics, "request_lookup_time"):
+        latest_requests = env_su["approval.request"]._get_latest_requests(model_name, [
+            (entry.id, res_id) for entry, matched_records in matches for res_id in matched_records.ids
+        ])
+
+    to_queue = []
+    for entry, matched_records in matches:
+        metrics["match_count"] += len(matched_records)
+        for res_id in matched_records._ids:
             # Check existing requests
-            existing_request = env_su["approval.request"].search([
-                ("rule_id", "=", triggered_rule.id),
-                ("res_model", "=", model_name),
-                ("res_id", "=", record.id)
-            ], order="create_date desc", limit=1)
+            existing_request = latest_requests.get((entry.id, res_id))
 
             if existing_request:
                 if existing_request.state == "approved":
-                    _logger.debug(f"{_log_prefix} Existing approved request found, adding to process list")
-                    processed_record_ids.add(record.id)
                     continue
                 elif existing_request.state == "pending":
-                    _logger.info(f"{_log_prefix} Pending request found: {existing_request.name}")
+                    _logger.info("%s Pending request found: %s", _log_prefix, existing_request.name)
                     raise UserError(_(
                         "This action requires approval. There's already a pending request:\n"
                         "Request: %s\n"
                         "Status: Waiting for %s"
                     ) % (existing_request.name, existing_request.current_step_id.name))
                 elif existing_request.state == "rejected":
-                    _logger.info(f"{_log_prefix} Rejected request found: {existing_request.name}")
+                    _logger.info("%s Rejected request found: %s", _log_prefix, existing_request.name)
                     raise UserError(_(
                         "This action was previously rejected.\n"
                         "Request: %s\n"
                         "Reason: %s"
-                    ) % (existing_request.name, existing_request.log_ids.filtered(
-                        lambda l: l.decision == 'rejected')[:1].reason or "Not specified"))
+                    ) % (existing_request.name, existing_request.rejection_reason or "Not specified"))
 
             # Create new approval request
-            first_step = triggered_rule.step_ids.sorted('sequence')[:1]
-            if not first_step:
-                _logger.error(f"{_log_prefix} No steps configured for rule {triggered_rule.name}")
+            if not entry.first_step_id:
+                triggered_rule = env_su["dynamic.approval.rule"].browse(entry.id)
+                _logger.error("%s No steps configured for rule %s", _log_prefix, triggered_rule.name)
                 raise UserError(_(
                     "Approval rule '%s' is misconfigured (no approval steps). "
                     "Please contact your administrator.") % triggered_rule.name)
 
-            try:
-                new_request = env_su['approval.request'].sudo().create({
-                    'rule_id': triggered_rule.id,
-                    'res_id': record.id,
-                    'origin_user_id': self.env.user.id,
-                    'current_step_id': first_step.id,
-                })
-                # Force compute and notifications
-                new_request._compute_current_approvers()
-                new_request._notify_approvers(first_step)
-
-                approval_requests_created.append(new_request)
-                _logger.info(f"""
-                {_log_prefix} Created new approval request:
-                - Request: {new_request.name} (ID: {new_request.id})
-                - Rule: {triggered_rule.name}
-                - Record: {model_name}, ID {record.id}
-                - Current Step: {first_step.name}
-                - Approvers: {new_request.current_approver_ids.mapped('name')}
-                """)
-
-            except Exception as e:
-                _logger.error(f"{_log_prefix} Failed to create approval request: {e}", exc_info=True)
-                raise UserError(_(
-                    "Failed to create approval request.\n"
-                    "Error details: %s\n\n"
-                    "Please contact your administrator.") % str(e))
-
-        if approval_requests_created:
-            requests_list = "\n".join([
-                f"- {req.name} (Waiting for {req.current_step_id.name})"
-                for req in approval_requests_created
-            ])
-            env_su.cr.commit()  # Force write to database
-            raise UserError(_(
-                "Action requires approval. The following requests have been created:\n\n"
-                "%s\n\n"
-                "The approvers have been notified. You'll receive a notification once processed."
-            ) % requests_list)
-
-        # Only process records that didn't need approval
-        records_to_process = self.filtered(lambda r: r.id in processed_record_ids)
-        if records_to_process:
-            _logger.debug(f"{_log_prefix} Processing records: {records_to_process.ids}")
-            return original_method(records_to_process, *args, **kwargs)
+            to_queue.append((entry.id, res_id, entry.first_step_id))
+    for request_model in ("approval.request", "approval.request.archive"):
+        env_su[request_model].browse(
+            request.id for request in latest_requests.values() if request._name == request_model
+        ).invalidate_recordset()
+    return to_queue
 
-        return None
 
-    return wrapper
+def _unpatch_method(env, model_name, method_name):
+    """ Restore the original method of ``model_name.method_name`` if it is wrapped. """
+    _patched_methods[env.cr.dbname].discard((model_name, method_name))
+    if model_name not in env:
+        return
+    ModelClass = env[model_name].__class__
+    wrapper = ModelClass.__dict__.get(method_name)
+    if not getattr(wrapper, '_is_dynamic_approval_wrapper', False):
+        return
+    if wrapper._dynamic_approval_inherited:
+        # The method was resolved through the MRO: drop the wrapper to resolve it again
+        delattr(ModelClass, method_name)
+    else:
+        setattr(ModelClass, method_name, wrapper.__wrapped__)
+    _logger.info(f"{_log_prefix} Restored original method {model_name}.{method_name}")
 
 
 def patch_models_for_approval(env):
-    """ Patches models based on active dynamic approval rules. """
+    """ Patches models based on active dynamic approval rules, and restores the
+    original methods that no longer have any active rule. """
     _logger.info(f"{_log_prefix} Starting model patching...")
     env_su = env(user=SUPERUSER_ID)
 
@@ -168,6 +442,11 @@ def patch_models_for_approval(env):
         _logger.error(f"{_log_prefix} Failed to search for rules: {e}")
         return
 
+    active_keys = {(rule.model_name, rule.method_name) for rule in rules}
+    for patch_key in list(_patched_methods[env.cr.dbname]):
+        if patch_key not in active_keys:
+            _unpatch_method(env, *patch_key)
+
     patched_methods = set()
 
     for rule in rules:
@@ -197,15 +476,14 @@ def patch_models_for_approval(env):
             if getattr(original_method, '_is_dynamic_approval_wrapper', False):
                 continue
 
-            # Store original method if not already stored
-            if patch_key not in _original_methods:
-                _original_methods[patch_key] = original_method
-
-            # Create and apply wrapper
+            # Create and apply wrapper; functools.wraps keeps the original method in
+            # __wrapped__, to restore it once the last rule is gone
             wrapper = _create_dynamic_approval_wrapper(model_name, method_name, original_method)
             wrapper._is_dynamic_approval_wrapper = True
+            wrapper._dynamic_approval_inherited = method_name not in ModelClass.__dict__
             setattr(ModelClass, method_name, wrapper)
             patched_methods.add(patch_key)
+            _patched_methods[env.cr.dbname].add(patch_key)
 
             _logger.info(f"{_log_prefix} Patched {model_name}.{method_name} for rule {rule.name}")
 
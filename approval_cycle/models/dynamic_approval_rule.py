@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 import inspect
 import logging
+from collections import defaultdict, namedtuple
+from datetime import timedelta
 
-from odoo import models, fields, api, _
+from odoo import models, fields, api, tools, SUPERUSER_ID, _
 from odoo.exceptions import UserError
 
+from . import base_model_patch
+
 _logger = logging.getLogger(__name__)
 
+# Immutable snapshot of an active rule, as stored in the registry-level rule index.
+RuleIndexEntry = namedtuple("RuleIndexEntry", ["id", "sequence", "domain", "write_date", "first_step_id"])
+
 class DynamicApprovalRule(models.Model):
     """ Defines the rules for triggering dynamic approvals. """
     _name = "dynamic.approval.rule"
@@ -42,12 +49,91 @@ class DynamicApprovalRule(models.Model):
         help="Define the sequence of approval steps required."
     )
     active = fields.Boolean(string="Active", default=True, help="Uncheck to disable this rule without deleting it.")
+    notification_mode = fields.Selection(
+        [("activity", "Activity per Approver"), ("digest", "Shared Work Item and Digest")],
+        string="Notifications",
+        default="activity",
+        required=True,
+        help="Activity per Approver: every approver gets an activity, and requesters are notified of each decision.\n"
+             "Shared Work Item and Digest: requests are only listed in the approval inbox of their approvers "
+             "(a step with a single approver still gets an activity), and approvers and requesters receive a "
+             "periodic summary instead of one notification per request. Recommended for large groups."
+    )
+    retention_days = fields.Integer(
+        string="Retention (Days)",
+        default=0,
+        help="Approved, rejected and cancelled requests closed for longer than this are moved to the "
+             "approval archive, and their chatter is removed. Leave 0 to keep them forever."
+    )
     method_selection_id = fields.Many2one(
         'studio.approval.method',
         string="Available Method",
         domain="[('model_id', '=', model_id)]"
     )
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        rules = super().create(vals_list)
+        self.env.registry.clear_cache()
+        self._update_registry()
+        return rules
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.env.registry.clear_cache()
+        if {"active", "model_id", "method_name"}.intersection(vals):
+            self._update_registry()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        self._update_registry()
+        return res
+
+    def _update_registry(self):
+        """ Install or remove the method wrappers after a change of the rules, in
+        this worker right away and in the other ones through the registry signaling. """
+        if self.env.registry.ready and not self.env.context.get("import_file"):
+            base_model_patch.patch_models_for_approval(self.env)
+            self.env.registry.registry_invalidated = True
+
+    # --- Rule Index --- #
+
+    @api.model
+    @tools.ormcache("model_name", "method_name")
+    def _get_rule_index(self, model_name, method_name):
+        """ Return the active rules for ``(model_name, method_name)`` as a tuple of
+        :class:`RuleIndexEntry`, ordered by sequence.
+
+        The result is cached per registry and cleared whenever a rule or a step is
+        created, modified or deleted; other workers are notified through the
+        registry cache signaling, so a call without matching rule costs no query.
+        """
+        rules = self.sudo().search([
+            ("model_name", "=", model_name),
+            ("method_name", "=", method_name),
+            ("active", "=", True),
+        ], order="sequence asc, id asc")
+        return tuple(
+            RuleIndexEntry(
+                id=rule.id,
+                sequence=rule.sequence,
+                domain=rule.domain or "[]",
+                write_date=rule.write_date,
+                first_step_id=rule.step_ids.sorted(lambda step: (step.sequence, step.id))[:1].id or False,
+            )
+            for rule in rules
+        )
+
+    @api.model
+    @tools.ormcache("self.env.lang")
+    def _get_target_model_selection(self):
+        """ Return the ``(model, name)`` selection of the models having an approval
+        rule, archived ones included, cached per registry and language. """
+        target_models = self.sudo().with_context(active_test=False).search([]).model_id
+        return tuple((model.model, model.name) for model in target_models.sorted("name"))
+
     @api.onchange('method_selection_id')
     def _onchange_method_selection_id(self):
         if self.method_selection_id:
@@ -61,25 +147,35 @@ class DynamicApprovalRule(models.Model):
             self._populate_available_methods(self.model_id)
 
     def _populate_available_methods(self, model):
-        methods = self._get_methods_for_model(model.model)
-        existing = self.env["studio.approval.method"].search(
-            [("model_id", "=", model.id)]
-        )
-        existing_names = {rec.name for rec in existing}
-        new_names = {name for name, _ in methods}
-
-        if existing_names != new_names:
-            existing.unlink()
-            for name, label in methods:
-                self.env["studio.approval.method"].create(
-                    {
-                        "name": name,
-                        "label": label,
-                        "model_id": model.id,
-                    }
-                )
+        """ Sync the ``studio.approval.method`` rows of ``model`` with its method
+        catalog, only creating, updating or deleting the rows that differ. """
+        methods = dict(self._get_methods_for_model(model.model))
+        Method = self.env["studio.approval.method"]
+        existing = Method.search([("model_id", "=", model.id)])
+
+        existing_by_name = {}
+        obsolete = Method
+        for rec in existing:
+            if rec.name not in methods or rec.name in existing_by_name:
+                obsolete |= rec
+            else:
+                existing_by_name[rec.name] = rec
+        obsolete.unlink()
 
+        for name, rec in existing_by_name.items():
+            if rec.label != methods[name]:
+                rec.label = methods[name]
+        Method.create([
+            {"name": name, "label": label, "model_id": model.id}
+            for name, label in methods.items()
+            if name not in existing_by_name
+        ])
+
+    @api.model
+    @tools.ormcache("model_name", cache="stable")
     def _get_methods_for_model(self, model_name):
+        """ Return the public methods of ``model_name`` as a sorted tuple of
+        ``(name, label)``, introspected once per registry. """
         method_list = []
         try:
             model_cls = self.env[model_name].__class__
@@ -96,7 +192,100 @@ class DynamicApprovalRule(models.Model):
                     method_list.append((name, label))
         except Exception as e:
             _logger.error(f"Error introspecting methods for model {model_name}: {e}")
-        return method_list
+        return tuple(method_list)
+
+    # --- Simulation --- #
+
+    def _simulate(self, chunk_size=1000, sample_size=20):
+        """ Dry-run this rule, active or not, against the existing records of its model.
+
+        Records are read in chunks of ``chunk_size`` by increasing id and matched the
+        way the interceptor does, the active rules of the same method that come first
+        in sequence taking precedence. Nothing is created, and the cache is cleared
+        after each chunk.
+
+        :return: dict with the number of ``scanned`` records, of records ``matched``
+            by this rule and of records ``preempted`` by a preceding rule, a sample
+            of ``matched_ids``, and the projected ``approver_volume``, as a dict
+            mapping the user ids to the number of requests they would have to
+            decide on if every request went through all the steps
+        """
+        self.ensure_one()
+        if self.model_name not in self.env:
+            raise UserError(_("The model %s of the rule does not exist.", self.model_name))
+        env_su = self.env(user=SUPERUSER_ID)
+        rule = self.with_env(env_su)
+        Model = env_su[self.model_name]
+
+        entry = RuleIndexEntry(
+            id=rule.id,
+            sequence=rule.sequence,
+            domain=rule.domain or "[]",
+            write_date=rule.write_date,
+            first_step_id=rule.step_ids.sorted(lambda step: (step.sequence, step.id))[:1].id or False,
+        )
+        preceding = [
+            other for other in rule._get_rule_index(rule.model_name, rule.method_name)
+            if other.id != rule.id and (other.sequence, other.id) < (entry.sequence, entry.id)
+        ]
+        applicable_rules = []
+        for index_entry in preceding + [entry]:
+            try:
+                applicable_rules.append((index_entry, base_model_patch._get_compiled_domain(env_su, index_entry)))
+            except Exception as e:
+                if index_entry.id == rule.id:
+                    raise UserError(_("The domain of the rule cannot be parsed: %s", e)) from e
+                _logger.error(f"Error parsing domain for rule {index_entry.id}: {e}")
+
+        result = {"scanned": 0, "matched": 0, "preempted": 0, "matched_ids": []}
+        last_id = 0
+        while True:
+            chunk = Model.search([("id", ">", last_id)], order="id", limit=chunk_size)
+            if not chunk:
+                break
+            last_id = chunk._ids[-1]
+            matches, _unmatched = base_model_patch._match_rules(chunk, applicable_rules)
+            result["scanned"] += len(chunk)
+            for index_entry, matched_records in matches:
+                if index_entry.id == rule.id:
+                    result["matched"] += len(matched_records)
+                    result["matched_ids"].extend(matched_records._ids[:sample_size - len(result["matched_ids"])])
+                else:
+                    result["preempted"] += len(matched_records)
+            chunk.invalidate_recordset()
+
+        approver_volume = defaultdict(int)
+        for step in rule.step_ids:
+            for user_id in step._get_approvers()._ids:
+                approver_volume[user_id] += result["matched"]
+        result["approver_volume"] = dict(approver_volume)
+        return result
+
+    def action_simulate(self):
+        """ Show the outcome of :meth:`_simulate` in a notification. """
+        self.ensure_one()
+        result = self._simulate()
+        top_approvers = sorted(result["approver_volume"].items(), key=lambda item: item[1], reverse=True)[:5]
+        users = self.env["res.users"].browse(user_id for user_id, _count in top_approvers)
+        message = _(
+            "%(matched)s of %(scanned)s existing records would require this approval "
+            "(%(preempted)s more are caught by rules of lower sequence).",
+            matched=result["matched"], scanned=result["scanned"], preempted=result["preempted"],
+        )
+        if top_approvers:
+            message += "\n" + _("Most solicited approvers: %s", ", ".join(
+                f"{user.name} ({count})" for user, (_user_id, count) in zip(users, top_approvers, strict=True)
+            ))
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("Simulation of %s", self.name),
+                "message": message,
+                "sticky": True,
+                "type": "info",
+            },
+        }
 
 class DynamicApprovalRuleStep(models.Model):
     """ Defines a single step in a dynamic approval rule sequence. """
@@ -125,6 +314,37 @@ class DynamicApprovalRuleStep(models.Model):
         string="Approving Group", 
         help="Select the user group whose members can approve this step."
     )
+    sla_hours = fields.Float(
+        string="SLA (Hours)",
+        help="Time the approvers have to decide on this step. Leave 0 for no deadline."
+    )
+    sla_action = fields.Selection(
+        [("remind", "Remind Approvers"), ("escalate", "Escalate"), ("reject", "Reject Automatically")],
+        string="When Overdue",
+        default="remind",
+        required=True,
+        help="What happens to requests still waiting on this step after its SLA: remind the approvers "
+             "again, let the escalation user or group approve as well, or reject the request."
+    )
+    escalation_user_id = fields.Many2one(
+        "res.users",
+        string="Escalation User",
+        domain=[("share", "=", False)],
+        help="User allowed to approve this step once a request is escalated."
+    )
+    escalation_group_id = fields.Many2one(
+        "res.groups",
+        string="Escalation Group",
+        help="Group whose members are allowed to approve this step once a request is escalated."
+    )
+    next_step_id = fields.Many2one(
+        "dynamic.approval.rule.step",
+        string="Next Step",
+        compute="_compute_next_step_id",
+        store=True,
+        readonly=True,
+        help="Step following this one in the rule's approval chain, if any."
+    )
 
     _sql_constraints = [
         ("approver_required", 
@@ -132,6 +352,53 @@ class DynamicApprovalRuleStep(models.Model):
          "An approving user or group must be specified for each step.")
     ]
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        steps = super().create(vals_list)
+        self.env.registry.clear_cache()
+        return steps
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.env.registry.clear_cache()
+        if {"approver_type", "user_id", "group_id", "escalation_user_id", "escalation_group_id"}.intersection(vals):
+            self.env["approval.request"]._sync_approver_index_for_steps(self)
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        return res
+
+    def _get_approvers(self):
+        """ Return the users allowed to approve this step. """
+        self.ensure_one()
+        if self.approver_type == "user":
+            return self.user_id
+        if self.approver_type == "group":
+            return self.group_id.users
+        return self.env["res.users"]
+
+    def _get_escalation_approvers(self):
+        """ Return the users allowed to approve this step once a request is escalated. """
+        self.ensure_one()
+        return self.escalation_user_id | self.escalation_group_id.users
+
+    def _get_due_date(self, start=None):
+        """ Return the deadline of a request entering this step at ``start``
+        (now by default), or ``False`` if the step has no SLA. """
+        self.ensure_one()
+        if self.sla_hours <= 0:
+            return False
+        return (start or fields.Datetime.now()) + timedelta(hours=self.sla_hours)
+
+    @api.depends("sequence", "rule_id.step_ids.sequence")
+    def _compute_next_step_id(self):
+        for step in self:
+            chain = step.rule_id.step_ids.sorted(lambda s: (s.sequence, s.id))
+            following = chain.filtered(lambda s, step=step: (s.sequence, s.id) > (step.sequence, step.id))
+            step.next_step_id = following[:1]
+
     @api.depends("approver_type", "user_id", "group_id", "sequence")
     def _compute_name(self):
         for step in self:
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from odoo import api, models
+
+from odoo.addons.base.models.res_users import is_reified_group
+
+
+class ResUsers(models.Model):
+    _inherit = "res.users"
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        users = super().create(vals_list)
+        self.env["approval.request"]._sync_approver_index_for_groups(users.groups_id)
+        return users
+
+    def write(self, vals):
+        # The user form sends the groups as reified fields (in_group_X, sel_groups_X_Y),
+        # only turned into groups_id by the base override called below
+        if "groups_id" not in vals and not any(is_reified_group(fname) for fname in vals):
+            return super().write(vals)
+        old_groups = self.groups_id
+        res = super().write(vals)
+        self.env["approval.request"]._sync_approver_index_for_groups(old_groups | self.groups_id)
+        return res
@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+from . import test_approval_performance
+from . import test_approver_index
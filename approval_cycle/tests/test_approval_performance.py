@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import logging
+import math
+import time
+from unittest.mock import patch
+
+from odoo.tests import TransactionCase, tagged
+from odoo.tools import SQL
+
+from odoo.addons.approval_cycle.models import base_model_patch
+from odoo.addons.approval_cycle.models.dynamic_approval_rule import DynamicApprovalRule
+
+_logger = logging.getLogger(__name__)
+
+BENCHMARK_METHOD = "approval_benchmark_noop"
+
+# Queries of the interceptor per rule and chunk of records: the rule's search,
+# within a savepoint
+INTERCEPTOR_QUERIES_PER_RULE_CHUNK = 3
+# Queries of the approver inbox page and of the pending counter
+INBOX_QUERIES = 1
+PENDING_COUNT_QUERIES = 1
+# Ceilings of the chatter-dependent costs: approving requests costs a fixed
+# amount, plus one chatter message per request and its notification, and a list
+# page reads each displayed relation once
+APPROVE_FIXED_QUERIES = 50
+APPROVE_QUERIES_PER_REQUEST = 25
+LIST_QUERIES = 20
+
+
+@tagged("post_install", "-at_install")
+class TestApprovalPerformance(TransactionCase):
+    """ Query-count regression suite of the approval engine.
+
+    Constant costs are checked against the baselines above. The costs that depend
+    on the chatter are checked against the ceilings above and for scaling:
+    approving many requests must cost the same per request as approving a few,
+    and loading a list must not depend on the number of historical requests.
+    Measures are logged as a table.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Rules are evaluated through the rule index: keep the registry and the
+        # model classes of the database out of the tests
+        cls.startClassPatcher(patch.object(DynamicApprovalRule, "_update_registry", lambda self: None))
+        # Keep the periodic flush of the interceptor metrics, through its own cursor, out of the measures
+        cls.startClassPatcher(patch.object(base_model_patch, "METRICS_FLUSH_INTERVAL", float("inf")))
+        cls.results = []
+        cls.partners = cls.env["res.partner"].create([
+            {"name": f"Approval Benchmark {i}"} for i in range(10000)
+        ])
+        cls.wrapper = base_model_patch._create_dynamic_approval_wrapper(
+            "res.partner", BENCHMARK_METHOD, lambda records, *args, **kwargs: None
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        width = max([len(case) for case, _queries, _seconds in cls.results] + [4])
+        lines = [f"{'Case':<{width}}  {'Queries':>8}  {'Time (ms)':>10}", "-" * (width + 22)]
+        lines += [f"{case:<{width}}  {queries:>8}  {seconds * 1000:>10.1f}" for case, queries, seconds in cls.results]
+        _logger.info("Approval engine benchmark:\n%s", "\n".join(lines))
+        super().tearDownClass()
+
+    # --- Helpers --- #
+
+    def _create_rules(self, count, domain):
+        model = self.env["ir.model"]._get("res.partner")
+        return self.env["dynamic.approval.rule"].create([{
+            "name": f"Approval Benchmark {i}",
+            "model_id": model.id,
+            "method_name": BENCHMARK_METHOD,
+            "domain": domain,
+            "step_ids": [(0, 0, {"approver_type": "user", "user_id": self.env.uid})],
+        } for i in range(count)])
+
+    def _measure(self, case, func, expected=None):
+        """ Run ``func`` on a clean cache, check its query count if ``expected``
+        is given, and return the number of queries it made. """
+        self.env.flush_all()
+        self.env.invalidate_all()
+        start_queries = self.cr.sql_log_count
+        start = time.perf_counter()
+        if expected is None:
+            func()
+            self.env.flush_all()
+        else:
+            with self.assertQueryCount(expected):
+                func()
+        queries = self.cr.sql_log_count - start_queries
+        self.results.append((case, queries, time.perf_counter() - start))
+        return queries
+
+    def _create_requests(self, rule, partners):
+        return self.env["approval.request"].create([{
+            "rule_id": rule.id,
+            "res_id": partner.id,
+            "current_step_id": rule.step_ids.id,
+        } for partner in partners])
+
+    # --- Cases --- #
+
+    def test_interceptor_overhead(self):
+        rules = self.env["dynamic.approval.rule"]
+        for rule_count in (0, 1, 10):
+            if len(rules) < rule_count:
+                rules |= self._create_rules(rule_count - len(rules), "[('id', '<', 0)]")
+            for record_count in (1, 100, 10000):
+                records = self.partners[:record_count]
+                self.wrapper(records)  # warm up the rule and domain caches
+                chunks = math.ceil(record_count / base_model_patch.INTERCEPT_CHUNK_SIZE)
+                self._measure(
+                    f"interceptor rules={rule_count} records={record_count}",
+                    lambda records=records: self.wrapper(records),
+                    expected=rule_count * chunks * INTERCEPTOR_QUERIES_PER_RULE_CHUNK,
+                )
+
+    def test_approve_throughput(self):
+        rule = self._create_rules(1, "[]")
+        # Warm up the caches of the approval and notification paths
+        self._create_requests(rule, self.partners[:5]).action_approve()
+
+        small = self._create_requests(rule, self.partners[5:35])
+        double = self._create_requests(rule, self.partners[35:95])
+        large = self._create_requests(rule, self.partners[95:395])
+        small_queries = self._measure("approve requests=30", small.action_approve)
+        double_queries = self._measure("approve requests=60", double.action_approve)
+        # Only the chatter of each request may cost queries per request
+        per_request = (double_queries - small_queries) / 30
+        self.assertLessEqual(per_request, APPROVE_QUERIES_PER_REQUEST)
+        self.assertLessEqual(small_queries, APPROVE_FIXED_QUERIES + 30 * APPROVE_QUERIES_PER_REQUEST)
+        self._measure(
+            "approve requests=300", large.action_approve,
+            expected=math.ceil(small_queries + per_request * 270),
+        )
+
+    def test_inbox_and_lists(self):
+        rule = self._create_rules(1, "[]")
+        Request = self.env["approval.request"]
+        list_fields = ["name", "resource_ref", "rule_id", "origin_user_id", "request_date",
+                       "current_step_id", "current_approver_ids", "state"]
+        cases = [
+            ("inbox page", lambda: Request.get_approval_inbox(limit=80), INBOX_QUERIES),
+            ("pending counter", Request.get_pending_approval_count, PENDING_COUNT_QUERIES),
+            ("to approve list", lambda: Request.search_read(
+                [("approver_index_ids.user_id", "=", self.env.uid)], list_fields, limit=80), None),
+            ("all requests list", lambda: Request.search_read([], list_fields, limit=80), None),
+        ]
+
+        self._generate_history(rule, 1000, 1)
+        small_queries = {
+            case: self._measure(f"{case} history=1000", func, expected=expected)
+            for case, func, expected in cases
+        }
+        for case, _func, expected in cases:
+            if expected is None:
+                self.assertLessEqual(small_queries[case], LIST_QUERIES, f"{case} exceeds its query ceiling")
+        self._generate_history(rule, 100000, 1001)
+        for case, func, _expected in cases:
+            # Loading a page must not depend on the size of the history
+            self._measure(f"{case} history=101000", func, expected=small_queries[case])
+
+    def _generate_history(self, rule, count, first_res_id):
+        """ Insert ``count`` closed requests and 1% of pending ones, on distinct
+        documents starting at ``first_res_id``. """
+        Request = self.env["approval.request"]
+        Request.flush_model()
+        pending_count = max(count // 100, 1)
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO %(table)s (rule_id, res_model_id, res_model, res_id, name, state, exec_state,
+                                   current_step_id, origin_user_id, request_date,
+                                   create_uid, create_date, write_uid, write_date)
+            SELECT %(rule_id)s, %(model_id)s, 'res.partner', %(first_res_id)s + n, 'Approval Benchmark',
+                   CASE WHEN n < %(pending)s THEN 'pending' WHEN mod(n, 5) = 0 THEN 'rejected' ELSE 'approved' END,
+                   'none',
+                   CASE WHEN n < %(pending)s THEN %(step_id)s END,
+                   %(uid)s, now() AT TIME ZONE 'UTC' - n * interval '1 minute',
+                   %(uid)s, now() AT TIME ZONE 'UTC', %(uid)s, now() AT TIME ZONE 'UTC'
+              FROM generate_series(0, %(count)s - 1) AS n
+         RETURNING id, state
+            """,
+            table=SQL.identifier(Request._table),
+            rule_id=rule.id,
+            model_id=rule.model_id.id,
+            first_res_id=first_res_id,
+            pending=pending_count,
+            step_id=rule.step_ids.id,
+            uid=self.env.uid,
+            count=count,
+        ))
+        Request.browse([row[0] for row in self.env.cr.fetchall() if row[1] == "pending"])._sync_approver_index()
+        Request.invalidate_model()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from unittest.mock import patch
+
+from odoo.tests import TransactionCase, tagged
+
+from odoo.addons.approval_cycle.models.dynamic_approval_rule import DynamicApprovalRule
+
+
+@tagged("post_install", "-at_install")
+class TestApproverIndex(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.startClassPatcher(patch.object(DynamicApprovalRule, "_update_registry", lambda self: None))
+        cls.approver_group = cls.env["res.groups"].create({"name": "Approval Test Approvers"})
+        cls.user = cls.env["res.users"].create({
+            "name": "Approval Test User",
+            "login": "approval_test_user",
+            "groups_id": [(6, 0, cls.env.ref("base.group_user").ids)],
+        })
+        rule = cls.env["dynamic.approval.rule"].create({
+            "name": "Approval Test Rule",
+            "model_id": cls.env["ir.model"]._get_id("res.partner"),
+            "method_name": "approval_test_noop",
+            "domain": "[]",
+            "step_ids": [(0, 0, {"approver_type": "group", "group_id": cls.approver_group.id})],
+        })
+        cls.request = cls.env["approval.request"].create({
+            "rule_id": rule.id,
+            "res_id": cls.env["res.partner"].create({"name": "Approval Test Partner"}).id,
+            "current_step_id": rule.step_ids.id,
+        })
+
+    def _assert_approver(self, is_approver):
+        self.env.invalidate_all()
+        Request = self.env["approval.request"].with_user(self.user)
+        self.assertEqual(Request.get_pending_approval_count(), 1 if is_approver else 0)
+        self.assertEqual(self.request.with_user(self.user).sudo().can_user_approve, is_approver)
+
+    def test_user_form_group_change(self):
+        """ The user form writes the groups through reified fields. """
+        group_field = f"in_group_{self.approver_group.id}"
+        self._assert_approver(False)
+        self.user.write({group_field: True})
+        self._assert_approver(True)
+        self.user.write({group_field: False})
+        self._assert_approver(False)
+
+    def test_group_users_change(self):
+        self.approver_group.write({"users": [(4, self.user.id)]})
+        self._assert_approver(True)
+        self.approver_group.write({"users": [(3, self.user.id)]})
+        self._assert_approver(False)